@@ -0,0 +1,71 @@
+import audio_preprocess
+
+# Renditions the client can ask for. Profiles with an output_format are
+# requested from ElevenLabs as is, profiles with a source are rendered from
+# that profile's MP3 and transcoded to Ogg/Opus here.
+AUDIO_PROFILES = {
+    # ElevenLabs' own default, what the bot always returned
+    "default": {"output_format": None, "content_type": "audio/mpeg", "extension": "mp3"},
+    "mp3_low": {"output_format": "mp3_22050_32", "content_type": "audio/mpeg", "extension": "mp3"},
+    "mp3_standard": {"output_format": "mp3_44100_64", "content_type": "audio/mpeg", "extension": "mp3"},
+    "mp3_high": {"output_format": "mp3_44100_128", "content_type": "audio/mpeg", "extension": "mp3"},
+    "opus_low": {"source": "mp3_standard", "sample_rate": 24000, "bitrate": 24000, "content_type": "audio/ogg",
+                 "extension": "ogg"},
+    "opus_standard": {"source": "mp3_high", "sample_rate": 48000, "bitrate": 48000, "content_type": "audio/ogg",
+                      "extension": "ogg"},
+}
+
+DEFAULT_PROFILE = "default"
+
+# Picked when the client only says which media types it accepts
+ACCEPT_PROFILES = (
+    ("audio/ogg", "opus_standard"),
+    ("audio/opus", "opus_standard"),
+    ("audio/mpeg", DEFAULT_PROFILE),
+)
+
+
+def needs_transcoding(profile):
+    return "source" in AUDIO_PROFILES[profile]
+
+
+def content_type(profile):
+    return AUDIO_PROFILES[profile]["content_type"]
+
+
+def file_extension(profile):
+    return AUDIO_PROFILES[profile]["extension"]
+
+
+def negotiate_profile(accept=None, requested=None):
+    """Choose the audio rendition for a response.
+
+    An explicitly requested profile wins, then the first audio type in the
+    Accept header that a profile serves. Opus profiles fall back to their
+    MP3 source when this container can't transcode.
+
+    Args:
+        accept (str): the request's Accept header
+        requested (str): profile name sent by the client
+
+    Returns:
+        str: name of the profile to render
+    """
+    if requested is not None:
+        if requested not in AUDIO_PROFILES:
+            raise ValueError(f"Unknown audio profile '{requested}'. Use one of: {', '.join(AUDIO_PROFILES)}.")
+        profile = requested
+    else:
+        accept = (accept or "").lower()
+        profile = next((p for media_type, p in ACCEPT_PROFILES if media_type in accept), DEFAULT_PROFILE)
+
+    if needs_transcoding(profile) and not audio_preprocess.is_available():
+        profile = AUDIO_PROFILES[profile]["source"]
+    return profile
+
+
+def transcode(audio, profile):
+    """Transcode source audio into the profile's Ogg/Opus rendition."""
+    settings = AUDIO_PROFILES[profile]
+    samples = audio_preprocess.decode_mono(audio, settings["sample_rate"])
+    return audio_preprocess.encode_opus(samples, settings["sample_rate"], settings["bitrate"])
@@ -0,0 +1,125 @@
+import io
+
+from coldstart import LazyModule
+
+# PyAV and numpy are imported by the first request that decodes or encodes audio
+av = LazyModule("av") if LazyModule.available("av") else None
+np = LazyModule("numpy") if LazyModule.available("numpy") else None
+
+# Whisper works on 16 kHz mono internally, anything above that is wasted upload
+TARGET_SAMPLE_RATE = 16000
+
+# VAD frames of 30 ms
+FRAME_SAMPLES = 480
+
+# Frames quieter than the loudest frame by this much count as silence,
+# and anything below SILENCE_FLOOR_DB is always silence
+SILENCE_RELATIVE_DB = 35.0
+SILENCE_FLOOR_DB = -50.0
+
+# Silence kept around the speech so word onsets aren't clipped
+PADDING_SAMPLES = TARGET_SAMPLE_RATE // 5
+
+OPUS_BITRATE = 24000
+
+
+def is_available():
+    return av is not None and np is not None
+
+
+def decode_mono(audio_data, sample_rate=TARGET_SAMPLE_RATE):
+    """Decode any container/codec PyAV understands into mono float32 at sample_rate."""
+    resampler = av.AudioResampler(format="flt", layout="mono", rate=sample_rate)
+    chunks = []
+    with av.open(io.BytesIO(audio_data)) as container:
+        for frame in container.decode(audio=0):
+            for resampled in resampler.resample(frame):
+                chunks.append(resampled.to_ndarray().reshape(-1))
+    for resampled in resampler.resample(None):
+        chunks.append(resampled.to_ndarray().reshape(-1))
+
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks).astype(np.float32, copy=False)
+
+
+def frame_energy_db(samples, frame_samples=FRAME_SAMPLES):
+    """RMS energy of consecutive frames in dBFS."""
+    n_frames = len(samples) // frame_samples
+    frames = samples[:n_frames * frame_samples].reshape(n_frames, frame_samples)
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+
+def trim_silence(samples, frame_samples=FRAME_SAMPLES, padding=PADDING_SAMPLES):
+    """Cut leading and trailing silence, the pauses inside the utterance are kept.
+
+    Returns:
+        numpy.ndarray: the trimmed samples (a view), empty if there was no speech
+    """
+    energy = frame_energy_db(samples, frame_samples)
+    if energy.size == 0:
+        return samples
+
+    threshold = max(energy.max() - SILENCE_RELATIVE_DB, SILENCE_FLOOR_DB)
+    voiced = np.flatnonzero(energy > threshold)
+    if voiced.size == 0:
+        return samples[:0]
+
+    start = max(voiced[0] * frame_samples - padding, 0)
+    end = min((voiced[-1] + 1) * frame_samples + padding, len(samples))
+    return samples[start:end]
+
+
+def encode_opus(samples, sample_rate=TARGET_SAMPLE_RATE, bitrate=OPUS_BITRATE):
+    """Encode mono float32 samples as Ogg/Opus."""
+    output = io.BytesIO()
+    with av.open(output, mode="w", format="ogg") as container:
+        stream = container.add_stream("libopus", rate=sample_rate)
+        stream.bit_rate = bitrate
+        stream.layout = "mono"
+
+        frame = av.AudioFrame.from_ndarray(samples.reshape(1, -1), format="flt", layout="mono")
+        frame.sample_rate = sample_rate
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return output.getvalue()
+
+
+def preprocess_for_stt(audio_data):
+    """Shrink an upload before it goes to Whisper.
+
+    Decodes the audio, downmixes it to mono at 16 kHz, trims leading and
+    trailing silence and re-encodes it as Ogg/Opus. The original is kept
+    whenever preprocessing isn't possible or doesn't make it smaller.
+
+    Args:
+        audio_data (bytes): audio as uploaded by the client
+
+    Returns:
+        (bytes, str, dict): audio to upload, its file name, and size/duration stats
+    """
+    stats = {"original_bytes": len(audio_data), "processed_bytes": len(audio_data), "bytes_saved": 0,
+             "preprocessed": False}
+    if av is None:
+        return audio_data, "audio.mp3", stats
+
+    try:
+        samples = decode_mono(audio_data)
+        trimmed = trim_silence(samples)
+        stats["original_ms"] = round(len(samples) * 1000 / TARGET_SAMPLE_RATE)
+        stats["trimmed_ms"] = round((len(samples) - len(trimmed)) * 1000 / TARGET_SAMPLE_RATE)
+        if trimmed.size == 0:
+            return audio_data, "audio.mp3", stats
+        encoded = encode_opus(trimmed)
+    except Exception as e:
+        print(f"Audio preprocessing failed, sending the original: {e}")
+        return audio_data, "audio.mp3", stats
+
+    if len(encoded) >= len(audio_data):
+        return audio_data, "audio.mp3", stats
+
+    stats.update(processed_bytes=len(encoded), bytes_saved=len(audio_data) - len(encoded), preprocessed=True)
+    return encoded, "audio.ogg", stats
@@ -0,0 +1,128 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Operations a single batch request may carry
+MAX_OPERATIONS = 20
+
+
+def _reference(value):
+    # "lesson.generated_text" -> ("lesson", "generated_text")
+    op_id, _, field = value.partition(".")
+    return op_id, field
+
+
+def validate(operations, types, max_operations=MAX_OPERATIONS, required=None):
+    """Check a batch before anything runs.
+
+    Every operation needs a unique id, a known type and the parameters its
+    type requires, given directly or taken from another operation. Inputs
+    taken from other operations ("from": {"param": "op_id.field"}) must
+    point at an operation of the same batch, and the dependencies can't
+    form a cycle.
+
+    Args:
+        operations (list of dict): the batch
+        types (iterable of str): accepted operation types
+        max_operations (int): largest accepted batch
+        required (dict): operation type -> names of the parameters it needs
+
+    Returns:
+        dict: op_id -> set of op_ids it depends on
+    """
+    if not isinstance(operations, list) or not operations:
+        raise ValueError("'operations' must be a non-empty list.")
+    if len(operations) > max_operations:
+        raise ValueError(f"A batch can hold at most {max_operations} operations.")
+
+    dependencies = {}
+    for op in operations:
+        if not isinstance(op, dict) or not op.get("id") or op.get("type") not in types:
+            raise ValueError(f"Every operation needs an 'id' and a 'type' out of {sorted(types)}.")
+        if op["id"] in dependencies:
+            raise ValueError(f"Duplicate operation id '{op['id']}'.")
+        references = op.get("from", {})
+        if not isinstance(references, dict) or not all(
+                isinstance(param, str) and isinstance(ref, str) and _reference(ref)[0]
+                for param, ref in references.items()):
+            raise ValueError(f"'from' of operation '{op['id']}' must map parameters to \"op_id.field\".")
+        needed = (required or {}).get(op["type"], ())
+        missing = [param for param in needed if param not in op and param not in references]
+        if missing:
+            raise ValueError(f"Operation '{op['id']}' needs {', '.join(repr(param) for param in missing)}.")
+        dependencies[op["id"]] = {_reference(ref)[0] for ref in references.values()}
+
+    for op_id, deps in dependencies.items():
+        unknown = deps - dependencies.keys()
+        if unknown:
+            raise ValueError(f"Operation '{op_id}' depends on unknown operations {sorted(unknown)}.")
+
+    # Kahn's algorithm, whatever is left over sits on a cycle
+    remaining = {op_id: set(deps) for op_id, deps in dependencies.items()}
+    ready = [op_id for op_id, deps in remaining.items() if not deps]
+    while ready:
+        done = ready.pop()
+        del remaining[done]
+        for op_id, deps in remaining.items():
+            if done in deps:
+                deps.discard(done)
+                if not deps:
+                    ready.append(op_id)
+    if remaining:
+        raise ValueError(f"Operations {sorted(remaining)} depend on each other.")
+    return dependencies
+
+
+def run_batch(operations, execute, error_result, max_workers=4):
+    """Run a batch, independent operations concurrently and dependent ones in order.
+
+    An operation starts as soon as everything it takes input from has
+    succeeded. Its "from" references are resolved into its parameters
+    first. If a dependency failed, the operation is not run and gets a 424.
+
+    Args:
+        operations (list of dict): a batch that passed validate()
+        execute (callable): (operation, params) -> result body, may raise
+        error_result (callable): exception -> (status code, result body)
+        max_workers (int): operations running at the same time
+
+    Returns:
+        list of dict: one {"id", "type", "statusCode", "body"} per operation, in request order
+    """
+    by_id = {op["id"]: op for op in operations}
+    dependencies = {op["id"]: {_reference(ref)[0] for ref in op.get("from", {}).values()} for op in operations}
+    results = {}
+
+    def finish(op_id, status_code, body):
+        results[op_id] = {"id": op_id, "type": by_id[op_id]["type"], "statusCode": status_code, "body": body}
+
+    def params_of(op):
+        params = {key: value for key, value in op.items() if key not in ("id", "type", "from")}
+        for param, ref in op.get("from", {}).items():
+            op_id, field = _reference(ref)
+            params[param] = results[op_id]["body"].get(field) if field else results[op_id]["body"]
+        return params
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while len(results) < len(operations):
+            for op_id, deps in dependencies.items():
+                if op_id in results or op_id in running.values() or not deps <= results.keys():
+                    continue
+                if any(results[dep]["statusCode"] != 200 for dep in deps):
+                    finish(op_id, 424, {"message": "A dependency of this operation failed."})
+                    continue
+                # Workers run in a copy of the caller's context so they report to its request trace
+                context = contextvars.copy_context()
+                running[executor.submit(context.run, execute, by_id[op_id], params_of(by_id[op_id]))] = op_id
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                op_id = running.pop(future)
+                try:
+                    finish(op_id, 200, future.result())
+                except Exception as e:
+                    finish(op_id, *error_result(e))
+
+    return [results[op["id"]] for op in operations]
@@ -0,0 +1,83 @@
+import contextvars
+import re
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
+
+# Words of consecutive windows compared when looking for their overlap
+MAX_OVERLAP_WORDS = 30
+
+# Fewer shared words than this is treated as coincidence, not overlap
+MIN_OVERLAP_WORDS = 2
+
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="chunked-stt")
+
+
+def _normalize(word):
+    return re.sub(r"[^\w']", "", word.lower())
+
+
+def merge_transcripts(left, right, max_overlap=MAX_OVERLAP_WORDS, min_overlap=MIN_OVERLAP_WORDS):
+    """Join two transcripts of overlapping audio windows, keeping the shared words once.
+
+    The longest run of words common to the end of left and the start of
+    right is taken as the overlap. Words before it come from left, words
+    from it onwards from right.
+    """
+    left_words, right_words = left.split(), right.split()
+    tail = [_normalize(w) for w in left_words[-max_overlap:]]
+    head = [_normalize(w) for w in right_words[:max_overlap]]
+
+    match = SequenceMatcher(None, tail, head, autojunk=False).find_longest_match(0, len(tail), 0, len(head))
+    if match.size < min(min_overlap, len(head)) or match.size == 0:
+        return " ".join(left_words + right_words)
+
+    cut = len(left_words) - len(tail) + match.a
+    return " ".join(left_words[:cut] + right_words[match.b:])
+
+
+def stitch(transcripts):
+    """Merge the transcripts of consecutive overlapping windows into one."""
+    text = ""
+    for transcript in transcripts:
+        text = merge_transcripts(text, transcript) if text else transcript.strip()
+    return text
+
+
+class ChunkedTranscriber:
+    """Transcribes an utterance while it is still being recorded.
+
+    Every segment added starts a background transcription of a window made
+    of the segment and the overlap segments before it, so each word is
+    heard in full by at least one window. Once recording stops only the
+    last window is still running, and finish() stitches all of them.
+
+    Args:
+        transcribe (callable): audio bytes to text, e.g. handler.transcribe_audio
+        overlap (int): previous segments included in each window
+    """
+
+    def __init__(self, transcribe, overlap=1):
+        self.transcribe = transcribe
+        self.overlap = overlap
+        self.segments = []
+        self.futures = []
+
+    def add(self, segment):
+        self.segments.append(segment)
+        # Concatenated MP3 segments decode as one stream
+        window = b"".join(self.segments[-(self.overlap + 1):])
+        context = contextvars.copy_context()
+        self.futures.append(_executor.submit(context.run, self.transcribe, window))
+
+    def partial(self):
+        """Stitched transcript of the windows finished so far, in order."""
+        done = []
+        for future in self.futures:
+            if not future.done() or future.exception() is not None:
+                break
+            done.append(future.result())
+        return stitch(done)
+
+    def finish(self):
+        """Wait for every window and return the full transcript."""
+        return stitch([future.result() for future in self.futures])
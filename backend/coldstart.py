@@ -0,0 +1,122 @@
+import builtins
+import importlib
+import importlib.util
+import sys
+import threading
+import time
+
+import metrics
+
+# Imports listed in the cold start report
+REPORT_TOP = 15
+
+
+class LazyModule:
+    """Stands in for a module that is only imported when first used.
+
+    The import runs once, under a lock, on the first attribute access, and
+    shows up as an "import" span in that request's trace. on_import gets the
+    module right after, to configure it once per container.
+    """
+
+    def __init__(self, name, on_import=None):
+        self.__dict__.update(_name=name, _on_import=on_import, _module=None, _lock=threading.Lock())
+
+    @staticmethod
+    def available(name):
+        return importlib.util.find_spec(name) is not None
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    with metrics.span("import", module=self._name):
+                        module = importlib.import_module(self._name)
+                        if self._on_import is not None:
+                            self._on_import(module)
+                    self.__dict__["_module"] = module
+        return self._module
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.load(), name, value)
+
+
+class ImportProfiler:
+    """Times every module imported while it is running, like python -X importtime.
+
+    Each record has the cumulative time of the import and its self time,
+    which leaves out the modules it imported in turn.
+    """
+
+    def __init__(self):
+        self.records = {}
+        self._stack = []
+        self._original_import = None
+
+    def start(self):
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._import
+        return self
+
+    def stop(self):
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self._original_import(name, globals, locals, fromlist, level)
+
+        self._stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - started
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            if name not in self.records:
+                self.records[name] = {"module": name, "ms": round(elapsed * 1000, 1),
+                                      "self_ms": round((elapsed - children) * 1000, 1)}
+
+    def report(self, top=REPORT_TOP):
+        """The slowest imports, by cumulative time."""
+        return sorted(self.records.values(), key=lambda r: r["ms"], reverse=True)[:top]
+
+
+_started = time.perf_counter()
+_profiler = None
+_first_request = True
+
+
+def profile_imports():
+    """Start timing imports, call before the module's other imports."""
+    global _profiler
+    if _profiler is None:
+        _profiler = ImportProfiler().start()
+
+
+def finish_init(**fields):
+    """Log how long the container's init took and, when profiling, where it went."""
+    global _profiler
+    report = {"init_ms": round((time.perf_counter() - _started) * 1000, 1), **fields}
+    if _profiler is not None:
+        _profiler.stop()
+        report["imports"] = _profiler.report()
+        _profiler = None
+    metrics.log("cold_start", **report)
+
+
+def first_request():
+    """True exactly once per container, for the request that follows the init."""
+    global _first_request
+    first, _first_request = _first_request, False
+    return first
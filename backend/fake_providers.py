@@ -0,0 +1,258 @@
+"""Local HTTP stand-ins for the OpenAI and ElevenLabs APIs, for load tests.
+
+    python fake_providers.py --openai-port 8101 --elevenlabs-port 8102 \\
+        --chat-latency lognormal:0.8,0.4 --tts-latency lognormal:0.6,0.3 --rate-429 0.02
+
+Point the handler at them with
+    OPENAI_API_BASE=http://127.0.0.1:8101/v1 ELEVEN_LABS_API_BASE=http://127.0.0.1:8102
+
+Unlike stub_providers.py, requests go over real sockets through the SDK and
+the pooled sessions, so connection handling and payload sizes count too.
+Latencies are distributions (seconds):
+    fixed:0.5   uniform:0.2,1.0   exp:0.5   lognormal:<median>,<sigma>
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Silent MPEG-1 Layer III frame (128 kbps, 44.1 kHz), about 26 ms of audio
+_SILENT_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413
+
+_WORDS = ("the", "a", "cat", "dog", "teacher", "student", "book", "coffee", "library", "morning", "reads", "walks",
+          "likes", "finds", "every", "quickly", "green", "small", "happy", "school", "park", "rain", "music", "city")
+
+
+def parse_latency(spec):
+    """Turn a latency spec such as "lognormal:0.8,0.4" into a sampler returning seconds."""
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "exp":
+        return lambda: random.expovariate(1 / values[0]) if values[0] else 0.0
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency distribution '{spec}'")
+
+
+class ProviderConfig:
+    """Behaviour of one fake endpoint.
+
+    Args:
+        latency (str): latency spec until the response starts
+        rate_429 (float): share of requests answered with 429 and a Retry-After
+        retry_after (float): Retry-After sent with a 429, in seconds
+    """
+
+    def __init__(self, latency="fixed:0", rate_429=0.0, retry_after=1.0):
+        self.latency = parse_latency(latency)
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+
+
+class FakeConfig:
+    """Latencies, 429 rates and payload sizes of the fake providers.
+
+    Args:
+        stt, chat, tts (ProviderConfig): behaviour of each endpoint
+        reply_words (tuple): (min, max) words per chat completion
+        transcript_words (tuple): (min, max) words per transcription
+        frames_per_char (int): MP3 frames of speech per character of TTS input
+    """
+
+    def __init__(self, stt=None, chat=None, tts=None, reply_words=(6, 16), transcript_words=(4, 12),
+                 frames_per_char=1):
+        self.stt = stt or ProviderConfig()
+        self.chat = chat or ProviderConfig()
+        self.tts = tts or ProviderConfig()
+        self.reply_words = reply_words
+        self.transcript_words = transcript_words
+        self.frames_per_char = frames_per_char
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+
+def _sentence(words):
+    # Random words, so replies are (almost) never TTS cache hits
+    text = " ".join(random.choice(_WORDS) for _ in range(random.randint(*words)))
+    return text[0].upper() + text[1:] + "."
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _throttled(self, endpoint, name):
+        if random.random() >= endpoint.rate_429:
+            return False
+        self.config.count(f"{name}_429")
+        body = json.dumps({"error": {"message": "Rate limit reached", "type": "rate_limit_error"}}).encode()
+        self.send_response(429)
+        self.send_header("Retry-After", str(endpoint.retry_after))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return True
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunked(self, chunks, content_type, chunk_latency=0.0):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunks:
+            time.sleep(chunk_latency)
+            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class _OpenAIHandler(_FakeHandler):
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.path.endswith("/audio/transcriptions"):
+            self.config.count("stt")
+            if self._throttled(self.config.stt, "stt"):
+                return
+            time.sleep(self.config.stt.latency())
+            self._send(json.dumps({"text": _sentence(self.config.transcript_words)}).encode(), "application/json")
+        elif self.path.endswith("/chat/completions"):
+            self.config.count("chat")
+            if self._throttled(self.config.chat, "chat"):
+                return
+            request = json.loads(body)
+            text = f'"{_sentence(self.config.reply_words)}"'
+            latency = self.config.chat.latency()
+            if request.get("stream"):
+                self._stream_chat(text, latency)
+                return
+            time.sleep(latency)
+            completion = {"id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                          "model": request.get("model"), "usage": {},
+                          "choices": [{"index": 0, "finish_reason": "stop",
+                                       "message": {"role": "assistant", "content": text}}]}
+            self._send(json.dumps(completion).encode(), "application/json")
+        else:
+            self.send_error(404)
+
+    def _stream_chat(self, text, latency):
+        # Server-sent events, the first token after a fifth of the latency
+        words = text.split(" ")
+        time.sleep(latency / 5)
+
+        def events():
+            for i, word in enumerate(words):
+                delta = {"content": word if i == 0 else " " + word}
+                chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk",
+                         "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n".encode()
+            yield b"data: [DONE]\n\n"
+
+        self._send_chunked(events(), "text/event-stream", latency * 4 / 5 / (len(words) + 1))
+
+
+class _ElevenLabsHandler(_FakeHandler):
+
+    def do_POST(self):
+        body = self._read_body()
+        match = re.match(r"^/v1/text-to-speech/[^/?]+(/stream)?", self.path)
+        if match is None:
+            self.send_error(404)
+            return
+        self.config.count("tts")
+        if self._throttled(self.config.tts, "tts"):
+            return
+
+        text = json.loads(body)["text"]
+        audio = _SILENT_FRAME * max(1, len(text) * self.config.frames_per_char)
+        latency = self.config.tts.latency()
+        if match.group(1):
+            # Streaming: first chunk after a quarter of the latency, the rest spread over the remainder
+            time.sleep(latency / 4)
+            chunks = [audio[i:i + 4096] for i in range(0, len(audio), 4096)]
+            self._send_chunked(chunks, "audio/mpeg", latency * 3 / 4 / len(chunks))
+        else:
+            time.sleep(latency)
+            self._send(audio, "audio/mpeg")
+
+
+def _serve(handler_class, config, host, port):
+    handler_class = type(handler_class.__name__, (handler_class,), {"config": config})
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start(config, host="127.0.0.1", openai_port=0, elevenlabs_port=0):
+    """Start both fakes on background threads.
+
+    Returns:
+        (str, str, list): the OpenAI API base, the ElevenLabs API base, and the servers to shut down
+    """
+    openai_server = _serve(_OpenAIHandler, config, host, openai_port)
+    elevenlabs_server = _serve(_ElevenLabsHandler, config, host, elevenlabs_port)
+    return (f"http://{host}:{openai_server.server_port}/v1", f"http://{host}:{elevenlabs_server.server_port}",
+            [openai_server, elevenlabs_server])
+
+
+def add_arguments(parser):
+    parser.add_argument("--stt-latency", default="lognormal:1.2,0.4", help="Whisper latency distribution")
+    parser.add_argument("--chat-latency", default="lognormal:0.9,0.4", help="GPT-4o latency distribution")
+    parser.add_argument("--tts-latency", default="lognormal:0.7,0.3", help="ElevenLabs latency distribution")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of provider requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After of those 429s, in seconds")
+    parser.add_argument("--reply-words", default="6,16", help="min,max words of a chat completion")
+    parser.add_argument("--frames-per-char", type=int, default=1, help="MP3 frames (26 ms) of audio per character")
+
+
+def config_from_args(args):
+    def endpoint(latency):
+        return ProviderConfig(latency, args.rate_429, args.retry_after)
+
+    return FakeConfig(endpoint(args.stt_latency), endpoint(args.chat_latency), endpoint(args.tts_latency),
+                      reply_words=tuple(int(n) for n in args.reply_words.split(",")),
+                      frames_per_char=args.frames_per_char)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run local fake OpenAI and ElevenLabs APIs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--openai-port", type=int, default=8101)
+    parser.add_argument("--elevenlabs-port", type=int, default=8102)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    openai_base, elevenlabs_base, _ = start(config_from_args(args), args.host, args.openai_port,
+                                            args.elevenlabs_port)
+    print(f"OPENAI_API_BASE={openai_base} ELEVEN_LABS_API_BASE={elevenlabs_base}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -1,123 +1,777 @@
+import os
+import coldstart
+
+# Set PROFILE_IMPORTS=true to log which imports the container's init time goes to
+if os.environ.get("PROFILE_IMPORTS", "false").lower() == "true":
+    coldstart.profile_imports()
+
 import json
 import base64
+import hashlib
 import io
-import openai
-import requests
-from requests.exceptions import Timeout
+import metrics
+import turn_budget
+from audio_formats import DEFAULT_PROFILE, AUDIO_PROFILES, needs_transcoding, content_type, file_extension, \
+    negotiate_profile, transcode
+from audio_preprocess import preprocess_for_stt
+import batch
+from hedging import Hedger
+from idempotency import (Idempotency, MemoryResponseStore, DiskResponseStore, DynamoResponseStore,
+                         IdempotencyKeyReusedError, RequestInProgressError)
+from history import HistoryCompactor, count_tokens
+from lesson_bank import LessonBank
+from pipeline import run_pipelined
+from prefetch import MemoryTicketStore, DynamoTicketStore, new_ticket
+from scoring import score_shadowing, score_batch, check_target
+from providers import ProviderClient, HTTPProviderClient, CircuitOpenError
+from scheduler import ProviderScheduler, RateLimitedError, current_user
+from singleflight import SingleFlight
+from turn_budget import BudgetExhaustedError
+from transport import PayloadTooLargeError, parse_request, wants_binary, text_headers, binary_response, header, \
+    decode_base64
+from tts_cache import TTSCache, MemoryLRU, DiskStore, LibraryStore, ChainedStore, cache_key
 
-openai.api_key = "YOUR_OPEN_AI_API_KEY"
+OPENAI_API_KEY = "YOUR_OPEN_AI_API_KEY"
 
-def transcribe_audio(audio_data):
+ELEVEN_LABS_API_KEY = "YOUR_ELEVEN_LABS_API_KEY"
+ELEVEN_LABS_VOICE_ID = "21m00Tcm4TlvDq8ikWAM"
+# Overridden to point at fake_providers.py in load tests, as is OPENAI_API_BASE
+ELEVEN_LABS_API_BASE = os.environ.get("ELEVEN_LABS_API_BASE", "https://api.elevenlabs.io")
+ELEVEN_LABS_VOICE_SETTINGS = {
+    "stability": 0,
+    "similarity_boost": 0
+}
+
+# Size of the audio chunks forwarded to the client in streaming mode
+STREAM_CHUNK_SIZE = 4096
+
+# The schedulers' buckets, slots and queues live in this process. On Lambda
+# every container has its own, so the account's quotas are split evenly
+# between the QUOTA_SHARES containers that can run at once, the function's
+# reserved concurrency (see serverless.yml). server.py is one process.
+QUOTA_SHARES = max(1, int(os.environ.get("QUOTA_SHARES", 1)))
+
+
+def _quota(name, default):
+    return max(1, int(os.environ.get(name, default)) // QUOTA_SHARES)
+
+
+# Upstream quotas per minute, shared fairly between users. The concurrency
+# limit adapts to the 429s and latency each provider returns.
+openai_scheduler = ProviderScheduler(
+    "openai",
+    limits={"requests": _quota("OPENAI_RPM", 500), "tokens": _quota("OPENAI_TPM", 30000)},
+    max_concurrency=_quota("OPENAI_MAX_CONCURRENCY", 16),
+    target_latency=float(os.environ.get("OPENAI_TARGET_LATENCY", 8))
+)
+elevenlabs_scheduler = ProviderScheduler(
+    "elevenlabs",
+    limits={"requests": _quota("ELEVEN_LABS_RPM", 100), "characters": _quota("ELEVEN_LABS_CPM", 20000)},
+    max_concurrency=_quota("ELEVEN_LABS_MAX_CONCURRENCY", 5),
+    target_latency=float(os.environ.get("ELEVEN_LABS_TARGET_LATENCY", 5))
+)
+
+# Provider clients live for the whole container so warm invocations reuse
+# their connections. Timeouts are per attempt, deadlines cover all retries
+# and stay under the 30 s function timeout.
+openai_client = ProviderClient(
+    "openai",
+    timeout=float(os.environ.get("OPENAI_TIMEOUT", 20)),
+    deadline=float(os.environ.get("OPENAI_DEADLINE", 25)),
+    scheduler=openai_scheduler
+)
+
+
+def _configure_openai(module):
+    # Runs once per container, right after the SDK's first import
+    module.api_key = OPENAI_API_KEY
+    module.requestssession = openai_client.session
+    openai_client.retryable_exceptions += (module.error.Timeout, module.error.APIConnectionError,
+                                           module.error.RateLimitError, module.error.ServiceUnavailableError,
+                                           module.error.TryAgain)
+
+
+# The openai SDK (aiohttp included) is most of the cold start, it is only
+# imported by the first request that calls OpenAI. Set PRELOAD_PROVIDERS=true
+# where init time is free, e.g. with provisioned concurrency.
+openai = coldstart.LazyModule("openai", on_import=_configure_openai)
+
+elevenlabs_client = HTTPProviderClient(
+    "elevenlabs",
+    timeout=float(os.environ.get("ELEVEN_LABS_TIMEOUT", 15)),
+    deadline=float(os.environ.get("ELEVEN_LABS_DEADLINE", 25)),
+    scheduler=elevenlabs_scheduler
+)
+
+# Synthesized clips are kept in memory for warm invocations and on disk.
+# A pre-rendered library (prerender.py) is consulted before the disk cache.
+tts_store = DiskStore(os.environ.get("TTS_CACHE_DIR", "/tmp/tts-cache"),
+                      max_bytes=int(os.environ.get("TTS_CACHE_DISK_BYTES", 256 * 1024 * 1024)))
+if os.environ.get("TTS_LIBRARY_DIR"):
+    tts_store = ChainedStore([LibraryStore(os.environ["TTS_LIBRARY_DIR"]), tts_store])
+tts_cache = TTSCache(
+    MemoryLRU(max_bytes=int(os.environ.get("TTS_CACHE_MEMORY_BYTES", 32 * 1024 * 1024))),
+    tts_store
+)
+
+# Long chat histories are cut down to the latest turns before they reach the model
+history_compactor = HistoryCompactor(
+    token_budget=int(os.environ.get("HISTORY_TOKEN_BUDGET", 3000)),
+    max_turns=int(os.environ.get("HISTORY_MAX_TURNS", 20))
+)
+
+# Identical chat completions and TTS clips requested concurrently share
+# one upstream call
+chat_flight = SingleFlight()
+tts_flight = SingleFlight()
+
+# Next lessons generated ahead of time, claimed with a ticket. Set
+# PREFETCH_TABLE on Lambda, the claim usually lands on another container
+prefetch_store = (DynamoTicketStore(os.environ["PREFETCH_TABLE"]) if os.environ.get("PREFETCH_TABLE")
+                  else MemoryTicketStore())
+PREFETCH_TTL = int(os.environ.get("PREFETCH_TTL", 120))
+
+# Responses of requests with an Idempotency-Key header are replayed to
+# retries. Set IDEMPOTENCY_TABLE on Lambda, a retry usually lands on another
+# container, or IDEMPOTENCY_DIR to share them between local processes.
+if os.environ.get("IDEMPOTENCY_TABLE"):
+    response_store = DynamoResponseStore(os.environ["IDEMPOTENCY_TABLE"])
+elif os.environ.get("IDEMPOTENCY_DIR"):
+    response_store = DiskResponseStore(os.environ["IDEMPOTENCY_DIR"])
+else:
+    response_store = MemoryResponseStore()
+idempotency = Idempotency(response_store, ttl=int(os.environ.get("IDEMPOTENCY_TTL", 600)))
+
+# Duplicate TTS calls that run past their stage's p90. Whisper isn't hedged,
+# the loser's upload can't be stopped once sent and would be billed in full
+HEDGING = os.environ.get("HEDGING", "false").lower() == "true"
+HEDGE_BUDGET = float(os.environ.get("HEDGE_BUDGET", 0.05))
+tts_hedger = Hedger("tts", budget=HEDGE_BUDGET, default_delay=3.0)
+
+# Decode, downmix, resample and trim uploads before they go to Whisper
+AUDIO_PREPROCESS = os.environ.get("AUDIO_PREPROCESS", "true").lower() == "true"
+
+# Concurrent TTS calls while the chat completion is still streaming
+PIPELINE_MAX_WORKERS = 3
+
+# Operations of one batch request that run at the same time
+BATCH_MAX_WORKERS = int(os.environ.get("BATCH_MAX_WORKERS", 4))
+
+# TTS time assumed before the container has seen enough turns, audio is
+# dropped when the turn's remaining budget can't cover it
+TTS_EXPECTED_SECONDS = 3.0
+
+# Lessons already generated are handed out again before asking the model
+lesson_bank = LessonBank(os.environ.get("LESSON_BANK_PATH", "/tmp/lesson-bank.json"))
+LESSON_MAX_ATTEMPTS = 3
+
+
+def _whisper_request(audio_data, file_name):
     # Convert the audio data into a file-like object using io.BytesIO
+    # A new one per attempt, retries must not start from a consumed file
     with io.BytesIO(audio_data) as audio_file:
-        audio_file.name = "audio.mp3"  # Add a name attribute to the BytesIO object
-        
+        audio_file.name = file_name  # Add a name attribute to the BytesIO object, Whisper reads the format from it
+
         # Use the OpenAI API to transcribe the audio, specifying the model, file, and language
-        response = openai.Audio.transcribe(model="whisper-1", file=audio_file, language="en")
-    
+        return openai.Audio.transcribe(model="whisper-1", file=audio_file, language="en")
+
+
+def transcribe_audio(audio_data):
+    file_name = "audio.mp3"
+    if AUDIO_PREPROCESS:
+        with metrics.span("preprocess") as span:
+            audio_data, file_name, stats = preprocess_for_stt(audio_data)
+            span.update(stats)
+
+    with metrics.span("whisper", upload_bytes=len(audio_data)):
+        response = openai_client.call(_whisper_request, audio_data, file_name, cost={"requests": 1})
+
     # Extract the transcribed text from the response
     transcription = response["text"]
     
     return transcription
 
 
-def generate_chat_completion(messages):
-    response = openai.ChatCompletion.create(
-        model="gpt-4o",
-        messages=messages,
-        max_tokens=100,
-        temperature=0.7
-    )
+def _chat_cost(messages):
+    # Prompt tokens plus the most the completion can use. The compactor has
+    # counted these messages already, the counts come from its cache.
+    return {"requests": 1, "tokens": sum(count_tokens(m) for m in messages) + 100}
+
+
+def _chat_completion_request(messages):
+    with metrics.span("chat", messages=len(messages)):
+        response = openai_client.call(
+            openai.ChatCompletion.create,
+            cost=_chat_cost(messages),
+            model="gpt-4o",
+            messages=messages,
+            max_tokens=100,
+            temperature=0.7
+        )
     return response.choices[0]["message"]["content"]
 
 
-def generate_audio(generated_text):
-    # API key
-    api_key = "YOUR_ELEVEN_LABS_API_KEY"
+def generate_chat_completion(messages):
+    key = hashlib.sha256(json.dumps(messages, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return chat_flight.do(key, _chat_completion_request, messages)
+
 
-    # Voice id
-    voice_id = "21m00Tcm4TlvDq8ikWAM"
+def stream_chat_completion(messages):
+    # Yield the completion content as the model generates it
+    with metrics.span("chat_stream_connect", messages=len(messages)):
+        response = openai_client.call(
+            openai.ChatCompletion.create,
+            cost=_chat_cost(messages),
+            model="gpt-4o",
+            messages=messages,
+            max_tokens=100,
+            temperature=0.7,
+            stream=True
+        )
+    for chunk in response:
+        content = chunk.choices[0]["delta"].get("content")
+        if content:
+            yield content
 
+
+def _tts_request(generated_text, stream=False, output_format=None, voice_id=None):
     # Voice params
     data = {
         "text": generated_text,
-        "voice_settings": {
-            "stability": 0,
-            "similarity_boost": 0
-        }
+        "voice_settings": ELEVEN_LABS_VOICE_SETTINGS
     }
 
-    # Call endpoint
-    url = f'https://api.elevenlabs.io/v1/text-to-speech/{voice_id}?api_key={api_key}'
+    # Call endpoint, the /stream variant sends audio as soon as it is synthesized
+    url = f'{ELEVEN_LABS_API_BASE}/v1/text-to-speech/{voice_id or ELEVEN_LABS_VOICE_ID}'
+    if stream:
+        url += '/stream'
+    url += f'?api_key={ELEVEN_LABS_API_KEY}'
+    if output_format:
+        url += f'&output_format={output_format}'
     headers = {
         'accept': 'audio/mpeg',
         'Content-Type': 'application/json'
     }
 
-    response = requests.post(url, headers=headers, json=data)
+    return elevenlabs_client.post(url, cost={"requests": 1, "characters": len(generated_text)},
+                                  headers=headers, json=data, stream=stream)
+
+
+def _tts_cache_key(generated_text, profile=DEFAULT_PROFILE, voice_id=None):
+    # Every rendition is cached on its own, the default one keeps its original key
+    variant = "" if profile == DEFAULT_PROFILE else profile
+    return cache_key(generated_text, voice_id or ELEVEN_LABS_VOICE_ID, ELEVEN_LABS_VOICE_SETTINGS, variant)
+
+
+def _render_speech(generated_text, profile=DEFAULT_PROFILE, voice_id=None):
+    if needs_transcoding(profile):
+        source = synthesize_speech(generated_text, AUDIO_PROFILES[profile]["source"], voice_id)
+        with metrics.span("transcode", profile=profile, source_bytes=len(source)) as span:
+            audio = transcode(source, profile)
+            span["audio_bytes"] = len(audio)
+        return audio
+
+    output_format = AUDIO_PROFILES[profile]["output_format"]
+    with metrics.span("tts", chars=len(generated_text), profile=profile) as span:
+        if HEDGING:
+            # Streamed, an attempt returns once the audio starts coming and the
+            # loser is closed before its body is downloaded
+            response = tts_hedger.run(_tts_request, generated_text, stream=True, output_format=output_format,
+                                      voice_id=voice_id)
+        else:
+            response = _tts_request(generated_text, output_format=output_format, voice_id=voice_id)
+        response.raise_for_status()
+        span["audio_bytes"] = len(response.content)
+    return response.content
+
+
+def synthesize_speech(generated_text, profile=DEFAULT_PROFILE, voice_id=None):
+    key = _tts_cache_key(generated_text, profile, voice_id)
+    return tts_flight.do(key, tts_cache.get_or_render, key, lambda: _render_speech(generated_text, profile, voice_id),
+                         file_extension(profile))
+
+
+def speech_within_budget(generated_text, profile=DEFAULT_PROFILE):
+    # Audio is the first thing dropped when the turn runs short of time or
+    # ElevenLabs can't be called right now, the text is ready either way. A
+    # cached clip is still served. Returns None when there is no audio.
+    if not turn_budget.fits("tts", TTS_EXPECTED_SECONDS):
+        return tts_cache.get(_tts_cache_key(generated_text, profile), file_extension(profile))
+    try:
+        return synthesize_speech(generated_text, profile)
+    except (BudgetExhaustedError, RateLimitedError, CircuitOpenError) as e:
+        metrics.annotate(tts_skipped=type(e).__name__)
+        return None
+
 
+def generate_audio(generated_text):
     # Bytes type is not JSON serializable
     # Convert to a Base64 string
-    return base64.b64encode(response.content).decode('utf-8')
+    return base64.b64encode(synthesize_speech(generated_text)).decode('utf-8')
 
 
-def handler(event, context):
+def stream_audio(generated_text, profile=DEFAULT_PROFILE):
+    # Yield raw audio chunks as ElevenLabs produces them. Transcoded
+    # renditions only exist once complete and are sent in chunks afterwards.
+    key = _tts_cache_key(generated_text, profile)
+    if needs_transcoding(profile):
+        audio = synthesize_speech(generated_text, profile)
+    else:
+        audio = tts_cache.get(key, file_extension(profile))
+    if audio is not None:
+        for start in range(0, len(audio), STREAM_CHUNK_SIZE):
+            yield audio[start:start + STREAM_CHUNK_SIZE]
+        return
+
+    with metrics.span("tts_stream_connect", chars=len(generated_text)):
+        response = _tts_request(generated_text, stream=True, output_format=AUDIO_PROFILES[profile]["output_format"])
+        response.raise_for_status()
+    chunks = []
     try:
-        body = json.loads(event["body"])
-
-        if 'audio' in body:
-            audio_base64 = body["audio"]
-            audio_data = base64.b64decode(audio_base64.split(",")[-1])
-            transcription = transcribe_audio(audio_data)
-            message_objects = body['messages'] + [{"role": "user", "content": transcription}]
-        elif 'text' in body:
-            transcription = body['text']
-            message_objects = body['messages']
-        else:
-            raise ValueError("Invalid request format. Either 'audio' or 'text' key must be provided.")
+        for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            if chunk:
+                chunks.append(chunk)
+                yield chunk
+    finally:
+        response.close()
 
-        if 'audio' not in body:
-            generated_text = generate_chat_completion(message_objects)
-        
-        # Check if audio response
-        is_audio_response = body.get('isAudioResponse', False)
+    # Only complete clips are cached
+    tts_cache.put(key, b"".join(chunks), file_extension(profile))
 
-        if is_audio_response:
-            generated_audio = generate_audio(generated_text)
-        else:
-            generated_audio = None
-
-        if 'audio' in body:
-            response = {
-                "statusCode": 200,
-                "headers": {"Access-Control-Allow-Origin": "*"},
-                "body": json.dumps(
-                    {"transcription": transcription, "generated_text": transcription, "generated_audio": generated_audio}),
-            }
-        else:
-            response = {
-                "statusCode": 200,
-                "headers": {"Access-Control-Allow-Origin": "*"},
-                "body": json.dumps(
-                    {"transcription": transcription, "generated_text": generated_text, "generated_audio": generated_audio}),
-            }
+
+def process_text(body, audio_data=None):
+    # Returns the (transcription, generated_text) pair for a request
+    if audio_data is not None:
+        transcription = transcribe_audio(audio_data)
+        generated_text = transcription
+    elif 'text' in body and 'lesson' in body:
+        transcription = body['text']
+        generated_text = generate_lesson(body)
+    elif 'text' in body:
+        transcription = body['text']
+        generated_text = generate_chat_completion(compact_messages(body))
+    else:
+        raise ValueError("Invalid request format. Either 'audio' or 'text' key must be provided.")
+
+    return transcription, generated_text
+
+
+def generate_lesson(body):
+    # Next lesson from the bank for this level and theme, the model is only
+    # called once the user has been given everything the bank holds. The
+    # client sends the user's recent lessons, this container may not have
+    # served them.
+    lesson = body['lesson']
+    level, theme = lesson.get('level', body.get('level')), lesson.get('theme')
+    user = current_user.get()
+    history = lesson.get('history', [])
+    if not isinstance(history, list) or not all(isinstance(text, str) for text in history):
+        raise ValueError("'lesson.history' must be a list of sentences.")
+    lesson_bank.remember(user, history)
+    generated_text = lesson_bank.next_for(user, level, theme)
+    if generated_text is not None:
+        metrics.annotate(lesson_source="bank")
+        return generated_text
+
+    metrics.annotate(lesson_source="model")
+    for _ in range(LESSON_MAX_ATTEMPTS):
+        # Bypass single-flight, retries with the same messages must not be shared
+        generated_text = _chat_completion_request(compact_messages(body))
+        if not lesson_bank.is_repeat(user, generated_text):
+            break
+    if lesson_bank.add(generated_text, level, theme) is not None:
+        lesson_bank.save()
+    lesson_bank.mark_delivered(user, generated_text)
+    return generated_text
+
+
+def compact_messages(body):
+    if not isinstance(body.get('messages'), list):
+        raise ValueError("'messages' must be a list of chat messages.")
+    return history_compactor.compact(body['messages'], body.get('conversationId'))
+
+
+def process_pipelined(body, profile=DEFAULT_PROFILE):
+    # Stream the chat completion and synthesize each sentence as soon as it
+    # is complete, so TTS runs while the model is still generating
+    sentences = []
+    segments = []
+    for sentence, audio in run_pipelined(stream_chat_completion(compact_messages(body)),
+                                         lambda text: speech_within_budget(text, profile), PIPELINE_MAX_WORKERS):
+        sentences.append(sentence)
+        segments.append(audio)
+    return " ".join(sentences), segments
+
+
+def run_turn(body, audio_data=None):
+    # Runs one chatbot turn, audio is kept as raw bytes
+    is_audio_response = body.get('isAudioResponse', False)
+    profile = body.get('audioProfile', DEFAULT_PROFILE)
+    segments = None
+    target = shadowing_target(body, audio_data)
+
+    if is_audio_response and body.get('pipelined', False) and audio_data is None and 'text' in body \
+            and 'lesson' not in body:
+        # MP3 frames can be concatenated as is, Ogg pages can't
+        if content_type(profile) != "audio/mpeg":
+            profile = DEFAULT_PROFILE
+        transcription = body['text']
+        generated_text, segments = process_pipelined(body, profile)
+        # A sentence without audio would leave a gap, drop the audio altogether
+        if any(segment is None for segment in segments):
+            segments = None
+        audio = b"".join(segments) if segments is not None else None
+    else:
+        transcription, generated_text = process_text(body, audio_data)
+        audio = speech_within_budget(generated_text, profile) if is_audio_response else None
+
+    result = {"transcription": transcription, "generated_text": generated_text, "audio": audio,
+              "audio_segments": segments, "audio_format": content_type(profile)}
+    if is_audio_response and audio is None:
+        # Out of time, the texts are returned without their audio
+        result["degraded"] = True
+        metrics.annotate(degraded="audio", budget_left_ms=round(1000 * (turn_budget.remaining() or 0)))
+
+    result["score"] = score_turn(target, transcription)
+    return result
+
+
+def shadowing_target(body, audio_data=None):
+    # The lesson sentence and level a shadowing turn is scored against,
+    # checked before anything is transcribed. None for other turns.
+    if audio_data is None or 'originalText' not in body:
+        return None
+    return check_target(body['originalText'], body.get('level'))
+
+
+def score_turn(target, transcription):
+    # Shadowing turns are scored against the lesson right away
+    if target is None:
+        return None
+    with metrics.span("score"):
+        return score_shadowing(target[0], transcription, target[1])
+
+
+def stream_turn(body, audio_data=None):
+    # Streaming variant of run_turn() for audio turns. Returns the response
+    # headers, texts and score included, and an iterator over the audio.
+    target = shadowing_target(body, audio_data)
+    transcription, generated_text = process_text(body, audio_data)
+    headers = text_headers(transcription, generated_text, score_turn(target, transcription))
+    headers["Content-Type"] = content_type(body['audioProfile'])
+    return headers, stream_audio(generated_text, body['audioProfile'])
+
+
+def json_response(payload, status_code=200):
+    return {
+        "statusCode": status_code,
+        "headers": {"Access-Control-Allow-Origin": "*"},
+        "body": json.dumps(payload),
+    }
+
+
+def prefetch_turn(body):
+    # Generate the next lesson and its audio now and park the result under a
+    # ticket, the client sends it back with the next request
+    result = run_turn({**body, "isAudioResponse": body.get("isAudioResponse", True)})
+    ticket = new_ticket()
+    prefetch_store.put(ticket, result, PREFETCH_TTL)
+    return {"ticket": ticket, "expires_in": PREFETCH_TTL}
+
+
+def claim_prefetched(body):
+    result = prefetch_store.claim(body['ticket'])
+    metrics.annotate(prefetch="hit" if result is not None else "miss")
+    if result is None and 'text' not in body:
+        raise ValueError("Unknown or expired prefetch ticket.")
+    return result
+
+
+def turn_payload(result, segmented=False):
+    # Bytes type is not JSON serializable
+    # Convert to a Base64 string. A pipelined turn's audio is sent either
+    # whole or, when the client asks for it, as one clip per sentence.
+    segmented = segmented and result["audio_segments"] is not None
+    response_body = {
+        "transcription": result["transcription"],
+        "generated_text": result["generated_text"],
+        "generated_audio": base64.b64encode(result["audio"]).decode('utf-8')
+        if result["audio"] is not None and not segmented else None,
+    }
+    if result["audio"] is not None:
+        response_body["audio_format"] = result["audio_format"]
+    if result.get("score") is not None:
+        response_body["score"] = result["score"]
+    if result.get("degraded"):
+        response_body["degraded"] = True
+    if segmented:
+        response_body["generated_audio_segments"] = [base64.b64encode(segment).decode('utf-8')
+                                                     for segment in result["audio_segments"]]
+    return response_body
+
+
+def turn_response(event, body, result):
+    if result["audio"] is not None and wants_binary(event, body):
+        return binary_response(result["audio"], result["transcription"], result["generated_text"],
+                               result["audio_format"], result.get("score"))
+    return json_response(turn_payload(result, body.get('audioSegments', False)))
+
+
+OPERATION_TYPES = ("turn", "transcribe", "chat", "speech", "score")
+# Parameters every operation of a type needs, directly or from another operation
+OPERATION_PARAMS = {
+    "transcribe": ("audio",),
+    "chat": ("text", "messages"),
+    "speech": ("text",),
+    "score": ("originalText", "transcription"),
+}
+
+
+def _run_operation(op, params):
+    # One operation of a batch request, params already carry the outputs of
+    # the operations it depends on
+    with metrics.span("operation", id=op["id"], type=op["type"]):
+        if params.get("audio") is not None and not isinstance(params["audio"], str):
+            raise ValueError("'audio' must be base64 text.")
+        if op["type"] == "turn":
+            audio = decode_base64(params["audio"]) if params.get("audio") else None
+            return turn_payload(run_turn(params, audio), params.get('audioSegments', False))
+        if op["type"] == "transcribe":
+            if not params.get("audio"):
+                raise ValueError("A transcribe operation needs 'audio'.")
+            return {"transcription": transcribe_audio(decode_base64(params["audio"]))}
+        if op["type"] == "chat":
+            return {"generated_text": process_text(params)[1]}
+        if op["type"] == "speech":
+            if not params.get("text"):
+                raise ValueError("A speech operation needs 'text'.")
+            profile = params["audioProfile"]
+            return {"generated_audio": base64.b64encode(synthesize_speech(params["text"], profile)).decode('utf-8'),
+                    "audio_format": content_type(profile)}
+        if op["type"] == "score":
+            return score_batch([params])[0]
+
+
+def _operation_error(e):
+    # Same status codes a single request would get
+    if isinstance(e, RateLimitedError):
+        return 429, {"message": "The service is busy, please try again.",
+                     "retryAfter": max(1, round(e.retry_after or 1))}
+    if isinstance(e, BudgetExhaustedError):
+        return 503, {"message": "The request took too long, please try again."}
+    if isinstance(e, CircuitOpenError):
+        return 503, {"message": "The service is unavailable, please try again.",
+                     "retryAfter": max(1, round(e.retry_after or 1))}
+    if isinstance(e, ValueError):
+        return 400, {"message": str(e)}
+    import traceback
+    print(traceback.format_exc())
+    return 500, {"message": "An error occurred while processing the request."}
+
+
+def run_operations(body):
+    # Several operations in one round trip, e.g. a lesson and then its audio
+    operations = body['operations']
+    batch.validate(operations, OPERATION_TYPES, required=OPERATION_PARAMS)
+    for op in operations:
+        # Operations inherit the request's negotiated audio profile unless they name one
+        op['audioProfile'] = negotiate_profile(None, op.get('audioProfile')) if 'audioProfile' in op \
+            else body['audioProfile']
+    return {"results": batch.run_batch(operations, _run_operation, _operation_error, BATCH_MAX_WORKERS)}
+
+
+def decode_request(event):
+    with metrics.span("decode", request_bytes=len(event.get("body") or "")) as span:
+        body, audio_data = parse_request(event)
+        span["audio_bytes"] = len(audio_data) if audio_data is not None else 0
+        body['audioProfile'] = negotiate_profile(header(event, 'accept'), body.get('audioProfile'))
+    return body, audio_data
+
+
+def encode_response(event, body, result):
+    with metrics.span("encode") as span:
+        response = turn_response(event, body, result)
+        span["response_bytes"] = len(response["body"])
+    return response
+
+
+# Everything above ran once, in the container's init
+if os.environ.get("PRELOAD_PROVIDERS", "false").lower() == "true":
+    openai.load()
+coldstart.finish_init(openai_loaded=openai.loaded)
+
+
+def error_response(e):
+    # Maps a failed request to its status code and message
+    if isinstance(e, PayloadTooLargeError):
+        metrics.annotate(error=str(e))
+        print(f"PayloadTooLargeError: {str(e)}")
+        response = {
+            "statusCode": 413,
+            "headers": {"Access-Control-Allow-Origin": "*"},
+            "body": json.dumps({"message": str(e)}),
+        }
+        return response
+    if isinstance(e, RateLimitedError):
+        metrics.annotate(error=str(e))
+        print(f"RateLimitedError: {str(e)}")
+        response = json_response({"message": "The service is busy, please try again."}, 429)
+        response["headers"]["Retry-After"] = str(max(1, round(e.retry_after or 1)))
+        return response
+    if isinstance(e, BudgetExhaustedError):
+        metrics.annotate(error=str(e))
+        print(f"BudgetExhaustedError: {str(e)}")
+        return json_response({"message": "The request took too long, please try again."}, 503)
+    if isinstance(e, CircuitOpenError):
+        metrics.annotate(error=str(e))
+        print(f"CircuitOpenError: {str(e)}")
+        response = json_response({"message": "The service is unavailable, please try again."}, 503)
+        response["headers"]["Retry-After"] = str(max(1, round(e.retry_after or 1)))
         return response
 
-    except ValueError as ve:
-        import traceback
-        print(traceback.format_exc())
-        print(f"ValueError: {str(ve)}")
+    import traceback
+    metrics.annotate(error=str(e))
+    print(traceback.format_exc())
+    if isinstance(e, ValueError):
+        print(f"ValueError: {str(e)}")
         response = {
             "statusCode": 400,
-            "body": json.dumps({"message": str(ve)}),
+            "body": json.dumps({"message": str(e)}),
         }
         return response
+    print(f"Error: {str(e)}")
+    response = {
+        "statusCode": 500,
+        "body": json.dumps({"message": "An error occurred while processing the request."}),
+    }
+    return response
+
+
+def _handle(event, request=None):
+    # request is the already decoded (body, audio_data), if the caller has it
+    try:
+        body, audio_data = request if request is not None else decode_request(event)
+        current_user.set(str(body.get('userId') or body.get('conversationId') or 'anonymous'))
+
+        if body.get('prefetch', False):
+            return json_response(prefetch_turn(body))
+
+        if 'operations' in body:
+            return json_response(run_operations(body))
+
+        # Scoring only, no providers involved
+        if 'score' in body:
+            return json_response(score_batch([body['score']])[0])
+        if 'scores' in body:
+            if not isinstance(body['scores'], list):
+                raise ValueError("'scores' must be a list of pairs.")
+            with metrics.span("score", pairs=len(body['scores'])):
+                return json_response({"results": score_batch(body['scores'])})
+
+        # A claimed ticket skips the chat completion and TTS entirely, an
+        # expired one falls back to a regular turn
+        result = claim_prefetched(body) if 'ticket' in body else None
+        if result is None:
+            result = run_turn(body, audio_data)
+        return encode_response(event, body, result)
+
     except Exception as e:
-        import traceback
-        print(traceback.format_exc())
-        print(f"Error: {str(e)}")
-        response = {
-            "statusCode": 500,
-            "body": json.dumps({"message": "An error occurred while processing the request."}),
-        }
+        return error_response(e)
+
+
+def handle_idempotent(event, request=None):
+    # Retries carrying the same key get the first attempt's response instead
+    # of running Whisper, GPT-4o and ElevenLabs again
+    key = header(event, 'idempotency-key')
+    if not key:
+        return _handle(event, request)
+
+    request_context = event.get("requestContext") or {}
+    scope = (event.get("path") or request_context.get("http", {}).get("path") or "",
+             header(event, 'authorization') or "")
+    try:
+        response, replayed = idempotency.run(Idempotency.scoped_key(key, *scope),
+                                             Idempotency.fingerprint(event.get("body") or ""),
+                                             _handle, event, request)
+    except IdempotencyKeyReusedError as e:
+        metrics.annotate(error=str(e))
+        return json_response({"message": str(e)}, 422)
+    except RequestInProgressError as e:
+        metrics.annotate(error=str(e))
+        response = json_response({"message": str(e)}, 409)
+        response["headers"]["Retry-After"] = "1"
         return response
+    metrics.annotate(idempotency="replayed" if replayed else "executed")
+    if replayed:
+        response = {**response, "headers": {**response.get("headers", {}), "Idempotent-Replayed": "true"}}
+    return response
+
+
+def handler(event, context):
+    trace = metrics.start_trace(getattr(context, "aws_request_id", None))
+    if coldstart.first_request():
+        trace.annotate(cold_start=True)
+    budget = turn_budget.start_from(context)
+    if budget is not None:
+        trace.annotate(budget_ms=round(budget * 1000))
+    response = handle_idempotent(event)
+    trace.finish(response["statusCode"], response_bytes=len(response["body"]))
+    return response
+
+
+# Requests handled by the router in _handle(), never streamed
+ROUTED_FIELDS = ('operations', 'score', 'scores', 'ticket')
+
+
+def streams_audio(event, body):
+    # Only plain turns asking for audio are streamed. Idempotent requests are
+    # buffered, a replay needs the complete response.
+    if body.get('prefetch', False) or any(field in body for field in ROUTED_FIELDS):
+        return False
+    return body.get('isAudioResponse', False) and not header(event, 'idempotency-key')
+
+
+def stream_response(event, context=None):
+    # handler() for servers that can stream the response body (server.py).
+    # An audio turn is answered once ElevenLabs sends its first chunk, the
+    # rest follows while it is still synthesizing and the texts travel in
+    # the headers. Every other request gets handler()'s buffered response.
+    # Returns the response and, when streamed, an iterator over its body,
+    # to be iterated in the context this was called in.
+    trace = metrics.start_trace(getattr(context, "aws_request_id", None))
+    if coldstart.first_request():
+        trace.annotate(cold_start=True)
+    turn_budget.start_from(context)
+    response = None
+    try:
+        request = decode_request(event)
+        body, audio_data = request
+        if streams_audio(event, body):
+            current_user.set(str(body.get('userId') or body.get('conversationId') or 'anonymous'))
+            headers, chunks = stream_turn(body, audio_data)
+            first_chunk = next(chunks, b"")
+        else:
+            response = handle_idempotent(event, request)
+    except Exception as e:
+        response = error_response(e)
+    if response is not None:
+        trace.finish(response["statusCode"], response_bytes=len(response["body"]))
+        return response, None
+
+    def audio_chunks():
+        status_code = 500
+        streamed_bytes = len(first_chunk)
+        try:
+            yield first_chunk
+            for chunk in chunks:
+                streamed_bytes += len(chunk)
+                yield chunk
+            status_code = 200
+        except Exception as e:
+            # Once audio has been sent the status can't change, the client sees a truncated body
+            metrics.annotate(error=str(e))
+            raise
+        finally:
+            trace.finish(status_code, response_bytes=streamed_bytes, streamed=True)
+
+    return {"statusCode": 200, "headers": headers, "body": ""}, audio_chunks()
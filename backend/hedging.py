@@ -0,0 +1,118 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+from metrics import RollingHistogram
+
+
+def _discard(future):
+    # Close a loser's response as soon as it exists. A streamed response
+    # hasn't been read yet, closing it drops the connection before the body
+    # is downloaded; anything else still gives its pooled connection back
+    if not future.cancelled() and future.exception() is None:
+        close = getattr(future.result(), "close", None)
+        if close is not None:
+            close()
+
+
+class Hedger:
+    """Sends a duplicate of a slow call and keeps whichever answers first.
+
+    The hedge fires once the call has run longer than the quantile of this
+    hedger's recent latencies (default_delay until min_samples calls have
+    been seen), measured from when the first attempt started running. At
+    most budget hedges are fired per call on average, so in the common case
+    no extra load is added. Every attempt gets its own thread. A blocking
+    call can't be interrupted, so the loser is closed the moment it returns:
+    hedge calls that return a streamed response (requests' stream=True),
+    which returns as soon as the headers arrive, and don't hedge calls whose
+    cost is spent before they return.
+
+    Args:
+        name (str): stage name used in the counters
+        quantile (int): latency percentile after which the hedge fires
+        budget (float): fraction of calls that may be hedged
+        default_delay (float): hedge delay in seconds before enough samples exist
+        min_delay (float): lower bound of the hedge delay in seconds
+        min_samples (int): calls needed before the percentile is trusted
+    """
+
+    def __init__(self, name, quantile=90, budget=0.05, default_delay=3.0, min_delay=0.2, min_samples=20):
+        self.name = name
+        self.quantile = quantile
+        self.budget = budget
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.latencies = RollingHistogram()
+        self.stats = {"calls": 0, "hedges_fired": 0, "hedges_won": 0}
+        self._lock = threading.Lock()
+
+    def delay(self):
+        percentiles = self.latencies.percentiles((self.quantile,))
+        if percentiles.get("count", 0) < self.min_samples:
+            return self.default_delay
+        return max(self.min_delay, percentiles[f"p{self.quantile}"] / 1000)
+
+    def _take_budget(self):
+        with self._lock:
+            if self.stats["hedges_fired"] + 1 > self.budget * self.stats["calls"]:
+                return False
+            self.stats["hedges_fired"] += 1
+            return True
+
+    def _start(self, fn, args, kwargs):
+        # A thread per attempt rather than a shared pool, queueing behind
+        # other calls' attempts would fire hedges for time spent waiting
+        # locally. Returns once the attempt is running, in its own copy of
+        # the caller's context (request trace, user).
+        future = Future()
+        future.set_running_or_notify_cancel()
+        context = contextvars.copy_context()
+        running = threading.Event()
+
+        def attempt():
+            running.set()
+            try:
+                result = context.run(fn, *args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        threading.Thread(target=attempt, name=f"hedge-{self.name}", daemon=True).start()
+        running.wait()
+        return future
+
+    def run(self, fn, *args, **kwargs):
+        with self._lock:
+            self.stats["calls"] += 1
+
+        primary = self._start(fn, args, kwargs)
+        started = time.monotonic()
+        done, _ = wait([primary], timeout=self.delay())
+
+        attempts = [primary]
+        if not done and self._take_budget():
+            attempts.append(self._start(fn, args, kwargs))
+
+        error = None
+        pending = set(attempts)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+
+                self.latencies.observe((time.monotonic() - started) * 1000)
+                if future is not primary:
+                    with self._lock:
+                        self.stats["hedges_won"] += 1
+                # Runs right away for a loser that already finished
+                for loser in attempts:
+                    if loser is not future:
+                        loser.add_done_callback(_discard)
+                return future.result()
+        raise error
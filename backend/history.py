@@ -0,0 +1,156 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+# Fixed cost of every chat message on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Token counts kept by message digest, shared by the compactor and the
+# schedulers' cost estimates
+MAX_CACHED_COUNTS = 8192
+_counts = OrderedDict()
+_counts_lock = threading.Lock()
+
+
+def _content_text(message):
+    content = message.get("content", "")
+    return content if isinstance(content, str) else json.dumps(content)
+
+
+@lru_cache(maxsize=None)
+def _encoding():
+    # Loading the BPE ranks is slow, it waits for the first message to count
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    return tiktoken.get_encoding("o200k_base")
+
+
+def _count(message):
+    text = _content_text(message)
+    encoding = _encoding()
+    if encoding is not None:
+        tokens = len(encoding.encode(text))
+    else:
+        tokens = (len(text) + 3) // 4
+    return tokens + MESSAGE_OVERHEAD_TOKENS
+
+
+def count_tokens(message, digest=None):
+    """Count (or, without tiktoken, estimate at ~4 characters per token) a message's tokens.
+
+    Counts are cached by the message's digest, pass it when it is already known.
+    """
+    digest = digest or message_digest(message)
+    with _counts_lock:
+        tokens = _counts.get(digest)
+        if tokens is not None:
+            _counts.move_to_end(digest)
+            return tokens
+    tokens = _count(message)
+    with _counts_lock:
+        _counts[digest] = tokens
+        if len(_counts) > MAX_CACHED_COUNTS:
+            _counts.popitem(last=False)
+    return tokens
+
+
+def message_digest(message):
+    payload = json.dumps([message.get("role"), _content_text(message)])
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def conversation_id(messages):
+    """Derive a conversation id from its opening messages when the client doesn't send one."""
+    return hashlib.sha1("".join(message_digest(m) for m in messages[:2]).encode("utf-8")).hexdigest()
+
+
+class _Conversation:
+    def __init__(self):
+        self.summaries = {}
+
+
+class HistoryCompactor:
+    """Keeps chat history within a token budget.
+
+    Leading system messages are always kept. The newest turns are kept for as
+    long as they fit in token_budget (at most max_turns of them, and at least
+    the latest one). Older turns are replaced by a summary when a summarize
+    callable is given, otherwise by a short note that they were dropped.
+
+    Token counts are cached by message (see count_tokens) and summaries per
+    conversation, so a turn that is resent unchanged is not counted or
+    summarized again.
+
+    Args:
+        token_budget (int): tokens allowed for the whole compacted history
+        max_turns (int): most non-system messages to keep verbatim
+        summarize (callable): turns a list of messages into a summary string
+        max_conversations (int): conversations whose counts are kept in memory
+    """
+
+    def __init__(self, token_budget=3000, max_turns=20, summarize=None, max_conversations=256):
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self.summarize = summarize
+        self.max_conversations = max_conversations
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _conversation(self, key):
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                conversation = self._conversations[key] = _Conversation()
+                if len(self._conversations) > self.max_conversations:
+                    self._conversations.popitem(last=False)
+            else:
+                self._conversations.move_to_end(key)
+            return conversation
+
+    def _placeholder(self, conversation, dropped, digests):
+        if self.summarize is None:
+            return {"role": "system", "content": f"{len(dropped)} earlier messages were omitted."}
+
+        key = hashlib.sha1("".join(digests).encode("utf-8")).hexdigest()
+        summary = conversation.summaries.get(key)
+        if summary is None:
+            summary = conversation.summaries[key] = self.summarize(dropped)
+        return {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+
+    def compact(self, messages, conversation_key=None):
+        """Return the messages to send to the model.
+
+        Args:
+            messages (list of dict): full history as sent by the client
+            conversation_key (str): id of the conversation, derived from messages if omitted
+
+        Returns:
+            list of dict: compacted history
+        """
+        conversation = self._conversation(conversation_key or conversation_id(messages))
+        digests = [message_digest(m) for m in messages]
+
+        head = 0
+        while head < len(messages) and messages[head].get("role") == "system":
+            head += 1
+
+        budget = self.token_budget - sum(count_tokens(messages[i], digests[i]) for i in range(head))
+
+        # Walk back from the newest turn until the budget or turn limit is reached
+        start = len(messages)
+        while start > head and len(messages) - start < self.max_turns:
+            tokens = count_tokens(messages[start - 1], digests[start - 1])
+            if tokens > budget and start < len(messages):
+                break
+            budget -= tokens
+            start -= 1
+
+        if start == head:
+            return list(messages)
+
+        placeholder = self._placeholder(conversation, messages[head:start], digests[head:start])
+        return messages[:head] + [placeholder] + messages[start:]
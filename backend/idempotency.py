@@ -0,0 +1,288 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from singleflight import SingleFlight
+
+# Long enough to cover a client's retries of the same turn
+DEFAULT_TTL = 600
+# Longest a request is expected to run, a pending marker older than this
+# was left by an attempt that died and is taken over
+PENDING_TTL = 60
+
+
+class IdempotencyKeyReusedError(Exception):
+    """The key was already used for a request with a different body."""
+
+
+class RequestInProgressError(Exception):
+    """The first attempt for the key is still running elsewhere."""
+
+
+class ResponseStore:
+    """Keeps responses under their idempotency key until they expire.
+
+    An entry is {"fingerprint": ..., "response": ...}. A response of None
+    marks a request that is still running.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def put(self, key, entry, ttl=DEFAULT_TTL):
+        raise NotImplementedError
+
+    def claim(self, key, fingerprint, ttl=PENDING_TTL):
+        """Store a pending entry unless key already has one. Returns whether it did."""
+        raise NotImplementedError
+
+    def release(self, key):
+        raise NotImplementedError
+
+
+class MemoryResponseStore(ResponseStore):
+    """ResponseStore for a single process, expired responses are dropped lazily."""
+
+    def __init__(self, max_responses=256):
+        self.max_responses = max_responses
+        self._responses = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        entry = self._responses.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            del self._responses[key]
+            entry = None
+        return entry[1] if entry is not None else None
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def _put(self, key, entry, ttl):
+        now = time.monotonic()
+        for expired in [k for k, (expires, _) in self._responses.items() if expires <= now]:
+            del self._responses[expired]
+        if key not in self._responses and len(self._responses) >= self.max_responses:
+            # Drop the response closest to expiry to make room
+            oldest = min(self._responses, key=lambda k: self._responses[k][0])
+            del self._responses[oldest]
+        self._responses[key] = (now + ttl, entry)
+
+    def put(self, key, entry, ttl=DEFAULT_TTL):
+        with self._lock:
+            self._put(key, entry, ttl)
+
+    def claim(self, key, fingerprint, ttl=PENDING_TTL):
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._put(key, {"fingerprint": fingerprint, "response": None}, ttl)
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._responses.pop(key, None)
+
+
+class DiskResponseStore(ResponseStore):
+    """Stores responses as <directory>/<key>.json, shared by every process using the directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self.path(key)) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if entry["expires"] <= time.time():
+            self.release(key)
+            return None
+        return {"fingerprint": entry.get("fingerprint"), "response": entry["response"]}
+
+    def put(self, key, entry, ttl=DEFAULT_TTL):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Write to a temporary file first so readers never see a partial response
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"expires": time.time() + ttl, **entry}, f)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def claim(self, key, fingerprint, ttl=PENDING_TTL):
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            # O_EXCL makes exactly one process create the marker
+            try:
+                fd = os.open(self.path(key), os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except FileExistsError:
+                if self.get(key) is not None:
+                    return False
+                # Expired and removed, or still being written by its creator
+                time.sleep(0.01)
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump({"expires": time.time() + ttl, "fingerprint": fingerprint, "response": None}, f)
+            return True
+
+    def release(self, key):
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class DynamoResponseStore(ResponseStore):
+    """ResponseStore in a DynamoDB table, shared by every Lambda container.
+
+    Items are {"idempotency_key": ..., "fingerprint": ..., "response": <JSON>,
+    "expires": <epoch seconds>}, a pending entry has no "response". Enable
+    TTL on "expires"; TTL deletion lags, so expiry is also checked on read
+    and by the conditional put that claims a key. Responses over the 400 KB
+    item limit aren't kept, retries of those run again.
+
+    Args:
+        table_name (str): table with the string partition key "idempotency_key"
+    """
+
+    MAX_ITEM_BYTES = 400 * 1024 - 1024
+
+    def __init__(self, table_name):
+        import boto3
+        self.table = boto3.resource("dynamodb").Table(table_name)
+        self._conflict = self.table.meta.client.exceptions.ConditionalCheckFailedException
+
+    def get(self, key):
+        item = self.table.get_item(Key={"idempotency_key": key}, ConsistentRead=True).get("Item")
+        if item is None or item["expires"] <= time.time():
+            return None
+        return {"fingerprint": item.get("fingerprint"),
+                "response": json.loads(item["response"]) if "response" in item else None}
+
+    def put(self, key, entry, ttl=DEFAULT_TTL):
+        response = json.dumps(entry["response"])
+        if len(response) > self.MAX_ITEM_BYTES:
+            self.release(key)
+            return
+        self.table.put_item(Item={"idempotency_key": key, "fingerprint": entry["fingerprint"],
+                                  "response": response, "expires": int(time.time() + ttl)})
+
+    def claim(self, key, fingerprint, ttl=PENDING_TTL):
+        now = time.time()
+        try:
+            self.table.put_item(
+                Item={"idempotency_key": key, "fingerprint": fingerprint, "expires": int(now + ttl)},
+                # Only one container creates the marker, an expired item is taken over
+                ConditionExpression="attribute_not_exists(idempotency_key) OR #expires <= :now",
+                ExpressionAttributeNames={"#expires": "expires"},
+                ExpressionAttributeValues={":now": int(now)},
+            )
+        except self._conflict:
+            return False
+        return True
+
+    def release(self, key):
+        self.table.delete_item(Key={"idempotency_key": key})
+
+
+class Idempotency:
+    """Runs a request at most once per idempotency key.
+
+    A completed response is stored and replayed to retries until the TTL
+    runs out. While the first attempt runs the store holds a pending marker,
+    retries arriving meanwhile, in this process or another one sharing the
+    store, wait for it and get the same response. Server errors and 429s
+    are not stored, so the client can retry those for real. Reusing a key
+    for a different request body raises IdempotencyKeyReusedError.
+
+    Args:
+        store (ResponseStore): where responses and pending markers are kept
+        ttl (int): seconds a response is replayed for
+        pending_ttl (int): seconds a pending marker is honoured, and the
+            longest a retry waits for it
+        poll_interval (float): seconds between checks of a pending marker
+    """
+
+    def __init__(self, store, ttl=DEFAULT_TTL, pending_ttl=PENDING_TTL, poll_interval=0.25):
+        self.store = store
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self.poll_interval = poll_interval
+        self._flight = SingleFlight()
+        self.stats = {"executed": 0, "replayed": 0}
+
+    @staticmethod
+    def scoped_key(key, *scope):
+        # Keys are client generated, scoping them keeps clients from replaying each other's responses
+        return hashlib.sha256("\x00".join((key,) + scope).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def fingerprint(body):
+        return hashlib.sha256(body.encode("utf-8") if isinstance(body, str) else body).hexdigest()
+
+    def _stored(self, key, fingerprint):
+        # The stored response, waiting while another attempt is pending.
+        # None once nothing is stored under key.
+        deadline = time.monotonic() + self.pending_ttl
+        while True:
+            entry = self.store.get(key)
+            if entry is None:
+                return None
+            if entry["fingerprint"] != fingerprint:
+                raise IdempotencyKeyReusedError("Idempotency-Key was already used for a different request")
+            if entry["response"] is not None:
+                return entry["response"]
+            if time.monotonic() >= deadline:
+                raise RequestInProgressError("A request with this Idempotency-Key is still in progress")
+            time.sleep(self.poll_interval)
+
+    def run(self, key, fingerprint, fn, *args, **kwargs):
+        """Call fn unless key has a stored or pending response.
+
+        Args:
+            key (str): the scoped idempotency key
+            fingerprint (str): hash of the request body, see fingerprint()
+
+        Returns:
+            (dict, bool): the response, and whether it is a replay
+        """
+        executed = []
+
+        def execute():
+            while True:
+                response = self._stored(key, fingerprint)
+                if response is not None:
+                    return response
+                if self.store.claim(key, fingerprint, self.pending_ttl):
+                    break
+
+            executed.append(True)
+            try:
+                response = fn(*args, **kwargs)
+            except BaseException:
+                self.store.release(key)
+                raise
+            if response["statusCode"] < 500 and response["statusCode"] != 429:
+                self.store.put(key, {"fingerprint": fingerprint, "response": response}, self.ttl)
+            else:
+                self.store.release(key)
+            return response
+
+        # Only the caller that ran fn appended to its own list, waiters and
+        # store hits get a replay. Callers with a different body don't share
+        # the flight, they find the pending marker instead.
+        response = self._flight.do((key, fingerprint), execute)
+        self.stats["executed" if executed else "replayed"] += 1
+        return response, not executed
@@ -0,0 +1,206 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict, defaultdict
+
+from coldstart import LazyModule
+
+# MinHash signature of NUM_PERM values, split into BANDS bands for LSH
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+
+# Estimated Jaccard similarity (of character shingles) above which two
+# lessons count as the same sentence
+DUPLICATE_THRESHOLD = 0.6
+
+SHINGLE_SIZE = 4
+
+# Most recent lessons of a user's own history that are checked against
+MAX_HISTORY = 200
+
+_PRIME = (1 << 31) - 1
+_A = _B = None
+
+
+def _draw_permutations(numpy):
+    # The universal hash coefficients, drawn once numpy has been imported
+    global _A, _B
+    rng = numpy.random.RandomState(1)
+    _A = rng.randint(1, _PRIME, size=NUM_PERM).astype(numpy.uint64)
+    _B = rng.randint(0, _PRIME, size=NUM_PERM).astype(numpy.uint64)
+
+
+# Only needed once a lesson is looked up or stored, not at cold start
+np = LazyModule("numpy", on_import=_draw_permutations)
+
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", "", text.lower())).strip()
+
+
+def minhash(text):
+    """MinHash signature of the text's character shingles."""
+    text = _normalize(text)
+    shingles = {text[i:i + SHINGLE_SIZE] for i in range(max(len(text) - SHINGLE_SIZE + 1, 1))}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) & _PRIME for s in shingles), dtype=np.uint64,
+                         count=len(shingles))
+    # One universal hash per permutation, all shingles at once
+    return ((_A[:, None] * hashes[None, :] + _B[:, None]) % _PRIME).min(axis=1)
+
+
+def similarity(a, b):
+    return float(np.mean(a == b))
+
+
+class LSHIndex:
+    """Near-duplicate index over MinHash signatures."""
+
+    def __init__(self, threshold=DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self.signatures = {}
+        self._buckets = defaultdict(set)
+
+    def _bands(self, signature):
+        for band in range(BANDS):
+            yield band, signature[band * ROWS:(band + 1) * ROWS].tobytes()
+
+    def add(self, item_id, signature):
+        self.signatures[item_id] = signature
+        for band in self._bands(signature):
+            self._buckets[band].add(item_id)
+
+    def find_duplicate(self, signature):
+        """Id of an indexed item similar to signature, or None."""
+        candidates = set()
+        for band in self._bands(signature):
+            candidates |= self._buckets.get(band, set())
+        for item_id in candidates:
+            if similarity(signature, self.signatures[item_id]) >= self.threshold:
+                return item_id
+        return None
+
+
+def length_bucket(text):
+    # Lessons are sized in words per sentence, see lessonPrompts in Bot.tsx
+    return len(_normalize(text).split())
+
+
+class LessonBank:
+    """Generated lesson sentences, indexed by level, theme and length.
+
+    Lessons for a (level, theme) pair are served in insertion order. Each
+    user has a cursor into every list, so handing out the next lesson is
+    O(1) amortized. Lessons that are near-duplicates of anything already
+    in the bank are not added, and a user is never served a lesson that is
+    a near-duplicate of one they have already been given.
+
+    What a user has been given is only known to the process that served
+    it, a request that lands on another container (or after a cold start)
+    has to bring the user's recent lessons along, see remember().
+
+    Args:
+        path (str): JSON file the bank is persisted to, optional
+        max_users (int): users whose history is kept in memory
+    """
+
+    def __init__(self, path=None, max_users=1024):
+        self.path = path
+        self.max_users = max_users
+        self.lessons = []
+        self._by_key = defaultdict(list)
+        self._index = LSHIndex()
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self._load()
+
+    @staticmethod
+    def _key(level, theme, words=None):
+        return str(level), (theme or "").strip().lower(), words
+
+    def _load(self):
+        with open(self.path) as f:
+            for lesson in json.load(f)["lessons"]:
+                self._insert(lesson["text"], lesson["level"], lesson.get("theme"), minhash(lesson["text"]))
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = {"lessons": list(self.lessons)}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def _insert(self, text, level, theme, signature):
+        lesson_id = len(self.lessons)
+        self.lessons.append({"text": text, "level": level, "theme": theme})
+        self._index.add(lesson_id, signature)
+        self._by_key[self._key(level, theme)].append(lesson_id)
+        self._by_key[self._key(level, theme, length_bucket(text))].append(lesson_id)
+        return lesson_id
+
+    def _user(self, user):
+        state = self._users.get(user)
+        if state is None:
+            state = self._users[user] = {"cursors": {}, "seen": LSHIndex()}
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user)
+        return state
+
+    def add(self, text, level, theme=None):
+        """Add a lesson unless the bank has a near-duplicate. Returns its id, or None."""
+        signature = minhash(text)
+        with self._lock:
+            if self._index.find_duplicate(signature) is not None:
+                return None
+            return self._insert(text, level, theme, signature)
+
+    def is_repeat(self, user, text):
+        """Whether the user has already been given a lesson like text."""
+        with self._lock:
+            return self._user(user)["seen"].find_duplicate(minhash(text)) is not None
+
+    def mark_delivered(self, user, text):
+        with self._lock:
+            self._mark(self._user(user)["seen"], minhash(text))
+
+    @staticmethod
+    def _mark(seen, signature):
+        # Near-duplicates are already covered, the index only grows with new lessons
+        if seen.find_duplicate(signature) is None:
+            seen.add(len(seen.signatures), signature)
+
+    def remember(self, user, texts):
+        """Record lessons the user was given elsewhere, e.g. the history their client sends."""
+        signatures = [minhash(text) for text in list(texts)[-MAX_HISTORY:] if text]
+        with self._lock:
+            seen = self._user(user)["seen"]
+            for signature in signatures:
+                self._mark(seen, signature)
+
+    def next_for(self, user, level, theme=None, words=None):
+        """Next lesson for the user at this level and theme that they haven't had, or None."""
+        key = self._key(level, theme, words)
+        with self._lock:
+            lesson_ids = self._by_key.get(key, [])
+            state = self._user(user)
+            cursor = state["cursors"].get(key, 0)
+            while cursor < len(lesson_ids):
+                lesson_id = lesson_ids[cursor]
+                cursor += 1
+                signature = self._index.signatures[lesson_id]
+                if state["seen"].find_duplicate(signature) is None:
+                    state["cursors"][key] = cursor
+                    state["seen"].add(len(state["seen"].signatures), signature)
+                    return self.lessons[lesson_id]["text"]
+            state["cursors"][key] = cursor
+        return None
@@ -0,0 +1,231 @@
+"""Replay a mix of chatbot turns against the handler and report latency percentiles.
+
+    python loadtest.py --requests 300 --concurrency 16 --mix audio=4,text=2,text_tts=3,pipelined=1
+    python loadtest.py --target http://127.0.0.1:8000 --duration 60
+
+By default the handler runs in this process against fake_providers.py,
+started here with the latency, 429 and payload options below, and the
+per-stage percentiles come from the handler's own metrics. With --target
+the turns go to a running server.py (/get-answer), which should itself
+point at the fakes (OPENAI_API_BASE, ELEVEN_LABS_API_BASE); stage
+percentiles are then read from its /metrics route.
+
+Turn kinds:
+    audio       recorded sentence in, transcription and score out
+    audio_tts   recorded sentence in, with audio in the response
+    text        text in, chat completion out
+    text_tts    text in, chat completion and its audio out
+    pipelined   as text_tts, TTS overlapped with the streamed completion
+"""
+import argparse
+import base64
+import io
+import json
+import math
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+import wave
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+import fake_providers
+from metrics import RollingHistogram
+
+TURN_KINDS = ("audio", "audio_tts", "text", "text_tts", "pipelined")
+DEFAULT_MIX = "audio=4,audio_tts=1,text=2,text_tts=2,pipelined=1"
+QUANTILES = (50, 90, 95, 99)
+
+
+def parse_mix(spec):
+    """Turn "audio=4,text=2" into ([kinds], [weights])."""
+    kinds, weights = [], []
+    for item in spec.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in TURN_KINDS:
+            raise ValueError(f"Unknown turn kind '{kind}'. Use one of: {', '.join(TURN_KINDS)}.")
+        kinds.append(kind)
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+def synthetic_recording(seconds=2.5, sample_rate=16000):
+    """A WAV 'utterance': a warbling tone between stretches of silence, as a base64 data URL."""
+    frames = bytearray()
+    for i in range(int(seconds * sample_rate)):
+        t = i / sample_rate
+        speaking = 0.4 < t < seconds - 0.4
+        value = 0.3 * math.sin(2 * math.pi * (180 + 40 * math.sin(2 * math.pi * 3 * t)) * t) if speaking else 0.0
+        frames += struct.pack("<h", int(value * 32767))
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(bytes(frames))
+    return "data:audio/wav;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def build_turn(kind, index, audio):
+    # Every turn gets its own history, so concurrent turns aren't collapsed by single-flight
+    user = f"loadtest-{index % 50}"
+    if kind.startswith("audio"):
+        return {"audio": audio, "originalText": "The cat sleeps on the warm mat.", "level": 3,
+                "messages": [], "isAudioResponse": kind == "audio_tts", "userId": user}
+    text = f"Tell me about turn {index}"
+    return {"text": text, "messages": [{"role": "user", "content": text}], "userId": user,
+            "isAudioResponse": kind != "text", "pipelined": kind == "pipelined"}
+
+
+class InProcessTarget:
+    """Calls handler.handler() directly, with the providers replaced by local fakes."""
+
+    def __init__(self, fake_config):
+        openai_base, elevenlabs_base, self.servers = fake_providers.start(fake_config)
+        self.fake_config = fake_config
+        self.workdir = tempfile.mkdtemp(prefix="loadtest-")
+
+        # The handler reads these at import time
+        os.environ["OPENAI_API_BASE"] = openai_base
+        os.environ["ELEVEN_LABS_API_BASE"] = elevenlabs_base
+        os.environ.setdefault("TTS_CACHE_DIR", os.path.join(self.workdir, "tts-cache"))
+        os.environ.setdefault("LESSON_BANK_PATH", os.path.join(self.workdir, "lesson-bank.json"))
+        import handler
+        import metrics
+        self.handler = handler
+        self.metrics = metrics
+
+    def send(self, body):
+        response = self.handler.handler({"body": json.dumps(body), "headers": {}}, None)
+        return response["statusCode"]
+
+    def stage_percentiles(self):
+        return self.metrics.stage_percentiles(QUANTILES)
+
+    def extra_stats(self):
+        return {"fake_providers": self.fake_config.stats, "tts_cache": self.handler.tts_cache.stats}
+
+    def close(self):
+        for server in self.servers:
+            server.shutdown()
+
+
+class HTTPTarget:
+    """Posts turns to a running server.py."""
+
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+
+    def send(self, body):
+        return self.session.post(f"{self.url}/get-answer", json=body, timeout=60).status_code
+
+    def stage_percentiles(self):
+        return self.session.get(f"{self.url}/metrics", timeout=10).json().get("stages", {})
+
+    def extra_stats(self):
+        return {}
+
+    def close(self):
+        self.session.close()
+
+
+def run(target, kinds, weights, concurrency, requests=None, duration=None, audio=None):
+    """Replay turns from the mix until requests have been sent or duration has passed.
+
+    Returns:
+        dict: end-to-end percentiles per turn kind and overall, status counts and throughput
+    """
+    audio = audio or synthetic_recording()
+    latencies = defaultdict(list)
+    statuses = Counter()
+    lock = threading.Lock()
+    counter = iter(range(sys.maxsize))
+    stop_at = time.monotonic() + duration if duration else None
+
+    def worker():
+        while True:
+            with lock:
+                index = next(counter)
+            if (requests is not None and index >= requests) or (stop_at and time.monotonic() >= stop_at):
+                return
+            kind = random.choices(kinds, weights)[0]
+            started = time.monotonic()
+            try:
+                status = target.send(build_turn(kind, index, audio))
+            except Exception as e:
+                status = type(e).__name__
+            elapsed_ms = (time.monotonic() - started) * 1000
+            with lock:
+                statuses[status] += 1
+                latencies[kind].append(elapsed_ms)
+                latencies["all"].append(elapsed_ms)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    wall = time.monotonic() - started
+
+    end_to_end = {}
+    for kind, values in latencies.items():
+        histogram = RollingHistogram(window=len(values))
+        for value in values:
+            histogram.observe(value)
+        end_to_end[kind] = histogram.percentiles(QUANTILES)
+    return {"wall_seconds": round(wall, 2), "throughput_rps": round(len(latencies["all"]) / wall, 2),
+            "statuses": {str(status): count for status, count in statuses.items()}, "end_to_end_ms": end_to_end}
+
+
+def print_report(report):
+    print(f"{sum(report['statuses'].values())} turns in {report['wall_seconds']} s "
+          f"({report['throughput_rps']} turns/s), statuses {report['statuses']}")
+    columns = ["count"] + [f"p{q}" for q in QUANTILES]
+    for title, rows in (("end to end (ms)", report["end_to_end_ms"]), ("stages (ms)", report["stages_ms"])):
+        print(f"\n{title:<22}" + "".join(f"{c:>10}" for c in columns))
+        for name, percentiles in sorted(rows.items()):
+            print(f"{name:<22}" + "".join(f"{percentiles.get(c, '-'):>10}" for c in columns))
+    for name, stats in report.get("extra", {}).items():
+        print(f"\n{name}: {stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the chatbot backend against local fake providers.")
+    parser.add_argument("--target", help="base URL of a running server.py, default: the handler in this process")
+    parser.add_argument("--concurrency", type=int, default=8, help="turns in flight at once")
+    parser.add_argument("--requests", type=int, help="turns to send (default 200 unless --duration is given)")
+    parser.add_argument("--duration", type=float, help="seconds to keep sending turns for")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"weighted turn kinds out of {', '.join(TURN_KINDS)}")
+    parser.add_argument("--audio", help="recording to send in audio turns, default: a synthetic one")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the handler's per-request log lines")
+    fake_providers.add_arguments(parser)
+    args = parser.parse_args()
+
+    kinds, weights = parse_mix(args.mix)
+    requests_count = args.requests if args.requests is not None or args.duration else 200
+    recording = None
+    if args.audio:
+        with open(args.audio, "rb") as f:
+            recording = base64.b64encode(f.read()).decode("ascii")
+
+    # The handler logs a JSON line per request (and one for its cold start)
+    with open(os.devnull, "w") as devnull, redirect_stdout(sys.stdout if args.verbose else devnull):
+        target = HTTPTarget(args.target) if args.target else InProcessTarget(fake_providers.config_from_args(args))
+        try:
+            report = run(target, kinds, weights, args.concurrency, requests_count, args.duration, recording)
+            report["stages_ms"] = target.stage_percentiles()
+            report["extra"] = target.extra_stats()
+        finally:
+            target.close()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
@@ -0,0 +1,143 @@
+import contextvars
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+# Latencies kept per stage for the rolling percentiles
+HISTOGRAM_WINDOW = 1024
+
+# A percentile summary line is logged every this many requests
+SUMMARY_EVERY = 50
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+_current_span = contextvars.ContextVar("span", default=None)
+
+
+class RollingHistogram:
+    """Latencies of the last `window` observations of one stage."""
+
+    def __init__(self, window=HISTOGRAM_WINDOW):
+        self._values = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._values.append(value)
+
+    def percentiles(self, quantiles=(50, 95, 99)):
+        with self._lock:
+            values = sorted(self._values)
+        if not values:
+            return {}
+        result = {"count": len(values)}
+        for q in quantiles:
+            # Nearest-rank percentile
+            index = min(len(values) - 1, max(0, int(round(q / 100 * len(values) + 0.5)) - 1))
+            result[f"p{q}"] = round(values[index], 1)
+        return result
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+_requests_seen = 0
+
+
+def histogram(stage):
+    with _histograms_lock:
+        if stage not in _histograms:
+            _histograms[stage] = RollingHistogram()
+        return _histograms[stage]
+
+
+def stage_percentiles(quantiles=(50, 95, 99)):
+    """Rolling percentiles (ms) of every stage seen by this container, p50/p95/p99 by default."""
+    with _histograms_lock:
+        stages = list(_histograms.items())
+    return {stage: h.percentiles(quantiles) for stage, h in stages}
+
+
+def log(event, **fields):
+    # Structured log line, CloudWatch Logs Insights parses the JSON fields
+    print(json.dumps({"event": event, **fields}, default=str))
+
+
+class Trace:
+    """Timing spans and attributes of one request, logged as a single JSON line."""
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id or str(uuid.uuid4())
+        self.started = time.perf_counter()
+        self.spans = []
+        self.fields = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, record):
+        with self._lock:
+            self.spans.append(record)
+
+    def annotate(self, **fields):
+        with self._lock:
+            self.fields.update(fields)
+
+    def finish(self, status_code, **fields):
+        global _requests_seen
+        total_ms = (time.perf_counter() - self.started) * 1000
+        histogram("total").observe(total_ms)
+        self.annotate(**fields)
+        log("request", request_id=self.request_id, status_code=status_code, total_ms=round(total_ms, 1),
+            spans=self.spans, **self.fields)
+
+        with _histograms_lock:
+            _requests_seen += 1
+            summarize = _requests_seen % SUMMARY_EVERY == 0
+        if summarize:
+            log("latency_summary", stages=stage_percentiles())
+
+
+def start_trace(request_id=None):
+    trace = Trace(request_id)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def span(stage, **fields):
+    """Time a stage of the current request.
+
+    The yielded dict is logged with the span, callers add fields to it
+    (payload sizes, cache hits...). The duration also feeds the stage's
+    rolling histogram, with or without a current trace.
+    """
+    record = {"stage": stage, **fields}
+    token = _current_span.set(record)
+    started = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        record["ms"] = round((time.perf_counter() - started) * 1000, 1)
+        histogram(stage).observe(record["ms"])
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(record)
+
+
+def annotate(**fields):
+    """Add fields to the innermost open span, or to the trace outside of spans."""
+    record = _current_span.get()
+    if record is not None:
+        record.update(fields)
+        return
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.annotate(**fields)
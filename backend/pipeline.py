@@ -0,0 +1,67 @@
+import contextvars
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# A sentence ends at ., ! or ? (optionally followed by closing quotes or
+# brackets) once the next piece of whitespace has arrived
+SENTENCE_END = re.compile(r'[.!?]+["\')\]]*\s+')
+
+# Sentences shorter than this are merged with the next one so that TTS
+# isn't called for fragments like "Yes."
+MIN_SEGMENT_CHARS = 20
+
+
+def split_sentences(deltas, min_chars=MIN_SEGMENT_CHARS):
+    """Yield complete sentences from a stream of text deltas as soon as they close.
+
+    Args:
+        deltas (iterable of str): text fragments in generation order
+        min_chars (int): minimum length of a yielded segment, except the last one
+
+    Yields:
+        str: the next sentence (or group of short sentences)
+    """
+    buffer = ""
+    for delta in deltas:
+        buffer += delta
+        while True:
+            match = next((m for m in SENTENCE_END.finditer(buffer) if m.end() >= min_chars), None)
+            if match is None:
+                break
+            yield buffer[:match.end()].strip()
+            buffer = buffer[match.end():]
+
+    if buffer.strip():
+        yield buffer.strip()
+
+
+def run_pipelined(deltas, synthesize, max_workers=3):
+    """Overlap text generation with speech synthesis.
+
+    Every complete sentence is handed to synthesize on a worker thread while
+    the deltas keep streaming in. Results are yielded in sentence order.
+
+    Args:
+        deltas (iterable of str): streamed chat completion content
+        synthesize (callable): turns a sentence into audio bytes
+        max_workers (int): number of concurrent synthesize calls
+
+    Yields:
+        (str, bytes): each sentence with its synthesized audio
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for sentence in split_sentences(deltas):
+            # Workers run in a copy of the caller's context so they report to its request trace
+            context = contextvars.copy_context()
+            pending.append((sentence, executor.submit(context.run, synthesize, sentence)))
+
+            # Hand over whatever is already finished, in order
+            while pending and pending[0][1].done():
+                sentence, future = pending.popleft()
+                yield sentence, future.result()
+
+        while pending:
+            sentence, future = pending.popleft()
+            yield sentence, future.result()
@@ -0,0 +1,119 @@
+import json
+import secrets
+import threading
+import time
+
+# Prefetched lessons are only useful for the next turn
+DEFAULT_TTL = 120
+
+
+def new_ticket():
+    return secrets.token_urlsafe(16)
+
+
+class TicketStore:
+    """Holds prefetched turn results until they are claimed once or expire."""
+
+    def put(self, ticket, result, ttl=DEFAULT_TTL):
+        raise NotImplementedError
+
+    def claim(self, ticket):
+        raise NotImplementedError
+
+
+class MemoryTicketStore(TicketStore):
+    """TicketStore for a single process, expired tickets are dropped lazily."""
+
+    def __init__(self, max_tickets=256):
+        self.max_tickets = max_tickets
+        self._tickets = {}
+        self._lock = threading.Lock()
+
+    def _purge(self, now):
+        expired = [ticket for ticket, (expires, _) in self._tickets.items() if expires <= now]
+        for ticket in expired:
+            del self._tickets[ticket]
+
+    def put(self, ticket, result, ttl=DEFAULT_TTL):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            if len(self._tickets) >= self.max_tickets:
+                # Drop the ticket closest to expiry to make room
+                oldest = min(self._tickets, key=lambda t: self._tickets[t][0])
+                del self._tickets[oldest]
+            self._tickets[ticket] = (now + ttl, result)
+
+    def claim(self, ticket):
+        with self._lock:
+            entry = self._tickets.pop(ticket, None)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+
+def _binary(value):
+    # boto3 hands binary attributes back wrapped in boto3.dynamodb.types.Binary
+    return bytes(getattr(value, "value", value))
+
+
+class DynamoTicketStore(TicketStore):
+    """TicketStore in a DynamoDB table, shared by every Lambda container.
+
+    Items are {"ticket": ..., "result": <JSON>, "audio": <binary>,
+    "audio_segments": [<binary>...], "expires": <epoch seconds>}, the audio
+    is kept out of the JSON as raw bytes. Enable TTL on "expires" so
+    DynamoDB removes unclaimed tickets. TTL deletion lags, so claim() checks
+    the expiry itself. A claim deletes the item, only one request can get
+    the result.
+
+    Items are limited to 400 KB. A result that doesn't fit loses its
+    per-sentence segments first, then its audio, and is claimed degraded
+    like a turn that ran out of time.
+
+    Args:
+        table_name (str): table with the string partition key "ticket"
+    """
+
+    MAX_ITEM_BYTES = 400 * 1024 - 1024
+
+    def __init__(self, table_name):
+        import boto3
+        self.table = boto3.resource("dynamodb").Table(table_name)
+
+    def _item(self, ticket, result, ttl):
+        fields = {name: value for name, value in result.items() if name not in ("audio", "audio_segments")}
+        item = {"ticket": ticket, "expires": int(time.time() + ttl)}
+        if result.get("audio") is not None:
+            item["audio"] = result["audio"]
+        if result.get("audio_segments") is not None:
+            item["audio_segments"] = list(result["audio_segments"])
+        item["result"] = json.dumps(fields)
+        return item
+
+    @staticmethod
+    def _size(item):
+        # Attribute names and values, close enough to DynamoDB's own count
+        size = 0
+        for name, value in item.items():
+            values = value if isinstance(value, list) else [value]
+            size += len(name) + sum(len(v) if isinstance(v, (bytes, str)) else 8 for v in values)
+        return size
+
+    def put(self, ticket, result, ttl=DEFAULT_TTL):
+        item = self._item(ticket, result, ttl)
+        if self._size(item) > self.MAX_ITEM_BYTES:
+            item = self._item(ticket, {**result, "audio_segments": None}, ttl)
+        if self._size(item) > self.MAX_ITEM_BYTES:
+            item = self._item(ticket, {**result, "audio": None, "audio_segments": None, "degraded": True}, ttl)
+        self.table.put_item(Item=item)
+
+    def claim(self, ticket):
+        item = self.table.delete_item(Key={"ticket": ticket}, ReturnValues="ALL_OLD").get("Attributes")
+        if item is None or item["expires"] <= time.time():
+            return None
+        result = json.loads(item["result"])
+        result["audio"] = _binary(item["audio"]) if "audio" in item else None
+        result["audio_segments"] = [_binary(segment) for segment in item["audio_segments"]] \
+            if "audio_segments" in item else None
+        return result
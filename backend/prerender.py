@@ -0,0 +1,138 @@
+"""Pre-render lesson audio into a content-addressed library.
+
+    python prerender.py lessons.jsonl --out library --profiles default,opus_low --workers 4
+
+The corpus is JSONL with a "text" field per line, or CSV with a "text"
+column. Optional "level" and "theme" fields are recorded in the manifest.
+Every sentence is rendered for every requested voice and audio profile,
+through the same provider client and rate limiter as the handler. Clips
+are stored under their TTS cache key, so the handler serves them as cache
+hits once TTS_LIBRARY_DIR points at the library. Re-running skips the
+clips that are already in the manifest.
+"""
+import argparse
+import csv
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import handler
+from audio_formats import AUDIO_PROFILES, content_type, file_extension
+from tts_cache import DiskStore, LibraryStore
+
+
+def read_corpus(path):
+    """Yield {text, level, theme} items from a JSONL or CSV corpus."""
+    with open(path, newline="") as f:
+        rows = csv.DictReader(f) if path.endswith(".csv") else (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            text = (row.get("text") or "").strip()
+            if text:
+                yield {"text": text, "level": row.get("level"), "theme": row.get("theme")}
+
+
+def load_manifest(directory):
+    path = os.path.join(directory, LibraryStore.MANIFEST)
+    if not os.path.exists(path):
+        return {"clips": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(directory, manifest):
+    # Written through a temporary file so the handler never loads half a manifest
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, os.path.join(directory, LibraryStore.MANIFEST))
+
+
+def _add_tag(entry, name, value):
+    if value is not None and str(value) not in entry[name]:
+        entry[name].append(str(value))
+
+
+def prerender(corpus, out, profiles, voice_ids, workers):
+    store = DiskStore(os.path.join(out, "audio"))
+    manifest = load_manifest(out)
+    clips = manifest["clips"]
+    stats = {"rendered": 0, "skipped": 0, "failed": 0, "bytes": 0}
+
+    jobs = {}
+    for item in read_corpus(corpus):
+        for voice_id in voice_ids:
+            for profile in profiles:
+                key = handler._tts_cache_key(item["text"], profile, voice_id)
+                if key in clips:
+                    _add_tag(clips[key], "levels", item["level"])
+                    _add_tag(clips[key], "themes", item["theme"])
+                    stats["skipped"] += 1
+                    continue
+                if key not in jobs:
+                    jobs[key] = {"text": item["text"], "profile": profile, "voice_id": voice_id, "levels": [],
+                                 "themes": []}
+                _add_tag(jobs[key], "levels", item["level"])
+                _add_tag(jobs[key], "themes", item["theme"])
+
+    print(f"{len(jobs)} clips to render, {stats['skipped']} already in the library")
+    started = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(handler.synthesize_speech, job["text"], job["profile"], job["voice_id"]): key
+                       for key, job in jobs.items()}
+            for future in as_completed(futures):
+                key = futures[future]
+                job = jobs[key]
+                try:
+                    audio = future.result()
+                except Exception as e:
+                    stats["failed"] += 1
+                    print(f"Failed to render '{job['text'][:40]}' ({job['profile']}): {e}")
+                    continue
+
+                extension = file_extension(job["profile"])
+                store.put(key, audio, extension)
+                clips[key] = {**job, "path": os.path.relpath(store.path(key, extension), out),
+                              "content_type": content_type(job["profile"]), "bytes": len(audio)}
+                stats["rendered"] += 1
+                stats["bytes"] += len(audio)
+                done = stats["rendered"] + stats["failed"]
+                if done % 50 == 0:
+                    print(f"{done}/{len(jobs)} clips, {time.monotonic() - started:.0f}s")
+    finally:
+        # Keep what was rendered even when the run is interrupted
+        write_manifest(out, manifest)
+
+    stats["seconds"] = round(time.monotonic() - started, 1)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-render lesson audio into a content-addressed library.")
+    parser.add_argument("corpus", help="JSONL or CSV file with a 'text' field")
+    parser.add_argument("--out", required=True, help="library directory")
+    parser.add_argument("--profiles", default=handler.DEFAULT_PROFILE,
+                        help=f"comma-separated audio profiles: {', '.join(AUDIO_PROFILES)}")
+    parser.add_argument("--voices", default=handler.ELEVEN_LABS_VOICE_ID, help="comma-separated ElevenLabs voice ids")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent renders")
+    parser.add_argument("--chars-per-minute", type=int, help="ElevenLabs character quota to stay under")
+    parser.add_argument("--stub", action="store_true", help="render with the local stub provider")
+    args = parser.parse_args()
+
+    profiles = args.profiles.split(",")
+    for profile in profiles:
+        if profile not in AUDIO_PROFILES:
+            parser.error(f"unknown audio profile '{profile}'")
+    if args.chars_per_minute:
+        handler.elevenlabs_scheduler.limits["characters"] = args.chars_per_minute
+    if args.stub:
+        import stub_providers
+        stub_providers.install(handler)
+
+    # The library is the persistent copy, don't fill the container cache too
+    handler.tts_cache.store = None
+
+    os.makedirs(args.out, exist_ok=True)
+    print(json.dumps(prerender(args.corpus, args.out, profiles, args.voices.split(","), args.workers)))
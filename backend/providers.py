@@ -0,0 +1,265 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import turn_budget
+from scheduler import RateLimitedError
+
+# Upstream statuses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose circuit breaker is open."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamStatusError(Exception):
+    """A provider answered with a retryable HTTP status."""
+
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"Upstream returned HTTP {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Stops calling a provider after consecutive failures.
+
+    After failure_threshold failures the circuit opens and calls fail fast
+    for reset_timeout seconds. Then a single trial call is let through
+    (half-open); its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def retry_after(self):
+        # Seconds until the next trial call is let through
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_skipped(self):
+        # The call never reached the provider, or didn't fail because of it.
+        # Neither closes nor opens the circuit, a half-open trial is given back.
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_flight or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class _DeadlineSession(requests.Session):
+    # Caps the timeout of every request, including the ones made by SDKs
+    # that pass their own (much longer) defaults, and keeps it within what
+    # is left of the turn's budget. A request that times out because of the
+    # budget raises BudgetExhaustedError, the provider wasn't too slow.
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        timeout = kwargs.get("timeout")
+        if timeout is None or isinstance(timeout, tuple):
+            kwargs["timeout"] = self.timeout
+        else:
+            kwargs["timeout"] = min(timeout, self.timeout)
+        left = turn_budget.remaining()
+        capped = left is not None and left < kwargs["timeout"]
+        if capped:
+            kwargs["timeout"] = max(0.1, left)
+        try:
+            return super().request(method, url, **kwargs)
+        except requests.exceptions.Timeout as e:
+            if capped:
+                raise turn_budget.BudgetExhaustedError(f"The turn ran out of time waiting for {url}") from e
+            raise
+
+
+def create_session(timeout, pool_maxsize=10):
+    """Create a keep-alive session whose requests never exceed timeout seconds."""
+    session = _DeadlineSession(timeout)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class ProviderClient:
+    """Runs provider calls with retries, jittered backoff and a circuit breaker.
+
+    Args:
+        name (str): provider name used in logs and errors
+        timeout (float): per-attempt timeout in seconds
+        deadline (float): total time budget for a call, retries included
+        max_retries (int): retries after the first attempt
+        backoff_base (float): first backoff ceiling in seconds, doubled on each retry
+        backoff_max (float): largest backoff ceiling in seconds
+        breaker (CircuitBreaker): breaker shared by every call to this provider
+        retryable_exceptions (tuple): exception types that are always retried
+        scheduler (ProviderScheduler): rate limiter every attempt goes through
+    """
+
+    def __init__(self, name, timeout=10.0, deadline=25.0, max_retries=2, backoff_base=0.25, backoff_max=4.0,
+                 breaker=None, retryable_exceptions=(), scheduler=None):
+        self.name = name
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.retryable_exceptions = (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                                     UpstreamStatusError) + tuple(retryable_exceptions)
+        self.session = create_session(timeout)
+        self.scheduler = scheduler
+
+    def is_retryable(self, exc):
+        if isinstance(exc, self.retryable_exceptions):
+            return True
+        return self.status_of(exc) in RETRY_STATUSES
+
+    @staticmethod
+    def status_of(value):
+        # HTTP status of a response or of a provider error, if it has one.
+        # openai errors carry http_status, requests' HTTPError carries a response
+        status = getattr(value, "status_code", None) or getattr(value, "http_status", None)
+        if status is None and getattr(value, "response", None) is not None:
+            status = getattr(value.response, "status_code", None)
+        return status
+
+    def backoff(self, attempt, exc=None):
+        # Full jitter: a random delay up to the exponential ceiling
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = getattr(exc, "retry_after", None)
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _attempt(self, fn, args, kwargs, cost, remaining):
+        if self.scheduler is None:
+            return fn(*args, **kwargs)
+
+        self.scheduler.acquire(cost or {"requests": 1}, timeout=remaining)
+        started = time.monotonic()
+        status = None
+        try:
+            result = fn(*args, **kwargs)
+            status = self.status_of(result) or 200
+            return result
+        except Exception as e:
+            status = self.status_of(e)
+            raise
+        finally:
+            self.scheduler.release(status, time.monotonic() - started)
+
+    def call(self, fn, *args, cost=None, **kwargs):
+        """Call fn(*args, **kwargs) with retries. cost is what the call uses of
+        the scheduler's quotas, e.g. {"requests": 1, "characters": 120}."""
+        started = time.monotonic()
+        left = turn_budget.remaining()
+        deadline = self.deadline if left is None else min(self.deadline, left)
+        attempt = 0
+        while True:
+            if deadline - (time.monotonic() - started) <= 0:
+                metrics.annotate(provider=self.name, budget="exhausted", attempts=attempt)
+                raise turn_budget.BudgetExhaustedError(f"No time left to call {self.name}")
+            if not self.breaker.allow():
+                metrics.annotate(provider=self.name, circuit="open")
+                raise CircuitOpenError(f"{self.name} circuit is open", self.breaker.retry_after())
+            try:
+                result = self._attempt(fn, args, kwargs, cost, deadline - (time.monotonic() - started))
+            except RateLimitedError:
+                self.breaker.record_skipped()
+                metrics.annotate(provider=self.name, throttled=True, attempts=attempt + 1)
+                raise
+            except turn_budget.BudgetExhaustedError:
+                # Cut short by the turn's budget, says nothing about the provider
+                self.breaker.record_skipped()
+                metrics.annotate(provider=self.name, budget="exhausted", attempts=attempt + 1)
+                raise
+            except Exception as e:
+                metrics.annotate(provider=self.name, status=self.status_of(e), attempts=attempt + 1)
+                if not self.is_retryable(e):
+                    # The provider answered, the request itself was bad
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                delay = self.backoff(attempt, e)
+                if attempt >= self.max_retries:
+                    raise
+                if time.monotonic() - started + delay > deadline:
+                    if deadline < self.deadline:
+                        # The turn's budget, not the provider's, is what ran out
+                        raise turn_budget.BudgetExhaustedError(f"No time left to retry {self.name}") from e
+                    raise
+                print(f"{self.name} call failed ({e}), retry {attempt + 1} in {delay:.2f}s")
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self.breaker.record_success()
+                metrics.annotate(provider=self.name, status=self.status_of(result) or 200, attempts=attempt + 1)
+                return result
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class HTTPProviderClient(ProviderClient):
+    """ProviderClient for plain HTTP APIs, sent through its pooled session."""
+
+    def post(self, url, cost=None, **kwargs):
+        def send():
+            response = self.session.post(url, **kwargs)
+            if response.status_code in RETRY_STATUSES:
+                response.close()
+                raise UpstreamStatusError(response.status_code, _retry_after(response))
+            return response
+
+        return self.call(send, cost=cost)
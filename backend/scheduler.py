@@ -0,0 +1,159 @@
+import contextvars
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Who the current upstream call is made for, used to share capacity fairly
+current_user = contextvars.ContextVar("scheduler_user", default="anonymous")
+
+
+class RateLimitedError(Exception):
+    """No upstream capacity could be granted before the call's deadline."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateStore:
+    """Shared token bucket state.
+
+    take() reserves amount tokens even when the bucket runs into debt and
+    returns how long the caller has to wait before using them, so callers
+    queue up behind each other instead of polling. A negative amount gives
+    tokens back. Implementations backed by a shared database let several
+    containers respect the same provider quota.
+    """
+
+    def take(self, key, amount, rate, capacity):
+        raise NotImplementedError
+
+
+class MemoryRateStore(RateStore):
+    """RateStore for a single process (and for tests)."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, amount, rate, capacity):
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            tokens -= amount
+            self._buckets[key] = (tokens, now)
+        return 0.0 if tokens >= 0 else -tokens / rate
+
+
+class ProviderScheduler:
+    """Shapes calls to one provider.
+
+    Every call needs a concurrency slot and enough budget in the provider's
+    token buckets. Slots are granted round-robin across users, so one busy
+    user can't starve the others. The concurrency limit adapts with AIMD:
+    it is halved when the provider answers 429 (or, with target_latency,
+    shrinks when it gets slow) and grows by about one per window of
+    successful calls.
+
+    Only the token buckets can be shared between processes, through the
+    store. Slots, the adaptive limit and the fairness queues are per
+    process, processes sharing a provider account split its quotas and
+    concurrency between them.
+
+    Args:
+        name (str): provider name, prefixes the bucket keys
+        limits (dict): per-minute quota of each cost dimension, e.g.
+            {"requests": 500, "tokens": 30000}
+        store (RateStore): bucket state, MemoryRateStore by default
+        max_concurrency (int): upper bound of the adaptive limit
+        min_concurrency (int): lower bound of the adaptive limit
+        target_latency (float): seconds above which a success counts as congestion
+    """
+
+    def __init__(self, name, limits, store=None, max_concurrency=16, min_concurrency=1, target_latency=None):
+        self.name = name
+        self.limits = limits
+        self.store = store or MemoryRateStore()
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.target_latency = target_latency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.stats = {"granted": 0, "rejected": 0, "throttled": 0}
+        self._queues = OrderedDict()
+        self._cond = threading.Condition()
+
+    def _next_waiter(self):
+        for queue in self._queues.values():
+            if queue:
+                return queue[0]
+        return None
+
+    def _wait_for_slot(self, user, deadline):
+        waiter = object()
+        with self._cond:
+            self._queues.setdefault(user, deque()).append(waiter)
+            while not (self.in_flight < max(int(self.limit), 1) and self._next_waiter() is waiter):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._queues[user].remove(waiter)
+                    if not self._queues[user]:
+                        del self._queues[user]
+                    self.stats["rejected"] += 1
+                    self._cond.notify_all()
+                    raise RateLimitedError(f"No {self.name} capacity within the deadline")
+                self._cond.wait(remaining)
+
+            # Served users go to the back of the rotation
+            queue = self._queues.pop(user)
+            queue.popleft()
+            if queue:
+                self._queues[user] = queue
+            self.in_flight += 1
+            self.stats["granted"] += 1
+
+    def _reserve(self, cost, deadline):
+        taken = []
+        wait = 0.0
+        for dimension, amount in cost.items():
+            per_minute = self.limits.get(dimension)
+            if not per_minute or not amount:
+                continue
+            key = f"{self.name}:{dimension}"
+            rate = per_minute / 60.0
+            wait = max(wait, self.store.take(key, amount, rate, per_minute))
+            taken.append((key, amount, rate, per_minute))
+
+        if wait <= 0:
+            return
+        if time.monotonic() + wait > deadline:
+            for key, amount, rate, per_minute in taken:
+                self.store.take(key, -amount, rate, per_minute)
+            self.stats["rejected"] += 1
+            raise RateLimitedError(f"{self.name} quota exhausted", retry_after=wait)
+        self.stats["throttled"] += 1
+        time.sleep(wait)
+
+    def acquire(self, cost, timeout, user=None):
+        """Wait for a slot and quota for one call, at most timeout seconds."""
+        deadline = time.monotonic() + timeout
+        self._wait_for_slot(user or current_user.get(), deadline)
+        try:
+            self._reserve(cost, deadline)
+        except BaseException:
+            self.release(None, 0.0)
+            raise
+
+    def release(self, status, latency):
+        """Free the slot and adapt the concurrency limit to the call's outcome."""
+        with self._cond:
+            self.in_flight -= 1
+            if status == 429:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+            elif status is not None and status < 400:
+                if self.target_latency is not None and latency > self.target_latency:
+                    self.limit = max(self.min_concurrency, self.limit * 0.9)
+                else:
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._cond.notify_all()
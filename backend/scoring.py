@@ -0,0 +1,105 @@
+import math
+import re
+from functools import lru_cache
+
+from diff_match_patch import diff_match_patch
+
+# Level changes, the same thresholds as the client
+LEVEL_UP_SCORE = 90
+LEVEL_DOWN_SCORE = 56
+MIN_LEVEL = 1
+MAX_LEVEL = 10
+
+# Largest batch accepted by score_batch
+MAX_BATCH = 500
+
+_dmp = diff_match_patch()
+# Lesson sentences are short, never let one pathological pair stall a batch
+_dmp.Diff_Timeout = 0.5
+
+
+def filter_punctuations(s):
+    """Remove punctuation, collapse repeated spaces and lowercase, like filterPunctuations in Bot.tsx."""
+    s = re.sub(r'[.,/#!$%^&*;:{}=\-_`~()]', '', s)
+    s = re.sub(r'\s{2,}', ' ', s)
+    return s.lower()
+
+
+@lru_cache(maxsize=4096)
+def _diff(transcription, original_text):
+    if transcription == original_text:
+        return ((0, transcription),) if transcription else ()
+    return tuple(tuple(d) for d in _dmp.diff_main(transcription, original_text))
+
+
+def compute_score(diffs):
+    """Percentage of equal characters in the diffs, rounded to 2 decimals like computeScore in Bot.tsx.
+
+    Ties round up like JavaScript's Math.round, Python's round() would round them to even.
+    """
+    similarities = sum(len(text) for op, text in diffs if op == 0)
+    differences = sum(len(text) for op, text in diffs if op != 0)
+    if similarities + differences == 0:
+        return 0.0
+    return math.floor(similarities / (similarities + differences) * 10000 + 0.5) / 100
+
+
+def next_level(level, score):
+    if score >= LEVEL_UP_SCORE and level < MAX_LEVEL:
+        return level + 1
+    if score < LEVEL_DOWN_SCORE and level > MIN_LEVEL:
+        return level - 1
+    return level
+
+
+def check_target(original_text, level=None):
+    """Validate what a transcription is scored against.
+
+    Returns:
+        (str, int or None): the lesson sentence and the level as an int
+    """
+    if not isinstance(original_text, str):
+        raise ValueError("'originalText' must be a string.")
+    if level is None:
+        return original_text, None
+    # Whole numbers only, 3 and 3.0 alike
+    if isinstance(level, bool) or not isinstance(level, (int, float)) or not float(level).is_integer():
+        raise ValueError("'level' must be a whole number.")
+    return original_text, int(level)
+
+
+def score_shadowing(original_text, transcription, level=None):
+    """Score a transcription against the lesson it shadows.
+
+    Args:
+        original_text (str): lesson sentence
+        transcription (str): what the learner said
+        level (int): current level, the new level is only returned when given
+
+    Returns:
+        dict: score (0-100), diffs as [op, text] pairs and the new level
+    """
+    diffs = _diff(filter_punctuations(transcription), filter_punctuations(original_text))
+    score = compute_score(diffs)
+    result = {"score": score, "diffs": [list(d) for d in diffs]}
+    if level is not None:
+        result["level"] = next_level(int(level), score)
+    return result
+
+
+def score_batch(pairs):
+    """Score many {originalText, transcription, level} items, identical pairs are diffed once."""
+    if not isinstance(pairs, list):
+        raise ValueError("Pairs to score must be a list.")
+    if len(pairs) > MAX_BATCH:
+        raise ValueError(f"At most {MAX_BATCH} pairs can be scored per request.")
+
+    results = []
+    for pair in pairs:
+        if not isinstance(pair, dict) or "originalText" not in pair or "transcription" not in pair:
+            raise ValueError("Each pair needs 'originalText' and 'transcription'.")
+        original_text, level = check_target(pair["originalText"], pair.get("level"))
+        if not isinstance(pair["transcription"], str):
+            raise ValueError("'transcription' must be a string.")
+        results.append(score_shadowing(original_text, pair["transcription"], level))
+    return results
@@ -0,0 +1,245 @@
+"""Long-running ASGI entry point for the chatbot backend.
+
+Runs the same pipeline as the Lambda handler, with provider clients,
+caches and metrics shared by every connection of the process.
+
+HTTP routes:
+    POST /get-answer          same request and response formats as the Lambda function
+    POST /get-answer/stream   same as /get-answer, except that audio turns are sent as raw
+                              audio while ElevenLabs is still synthesizing, with the texts
+                              and score in X-Transcription, X-Generated-Text and X-Score
+    GET  /metrics             rolling per-stage latency percentiles
+    GET  /healthz             liveness check
+
+WebSocket /voice, one conversation per connection. Client messages:
+    {"type": "audio_start", ...fields}   start an utterance, fields as in a
+                                          /get-answer body (originalText, level...).
+                                          With "chunked": true every binary frame is
+                                          transcribed while recording continues
+    <binary frames>                       microphone audio chunks
+    {"type": "audio_end"}                 transcribe the utterance
+    {"type": "text", "text": ..., "messages": [...], "isAudioResponse": ...}
+Server messages:
+    {"type": "partial_transcription", "text": ...}   chunked mode only
+    {"type": "transcription", "text": ..., "score": ...}
+    {"type": "sentence", "text": ...} followed by the sentence's audio as a binary frame
+    {"type": "done", "generated_text": ...}
+    {"type": "error", "message": ...}
+
+Run locally with stub providers for load tests:
+    python server.py --stub --port 8000
+or against fake_providers.py over HTTP, driven by loadtest.py:
+    OPENAI_API_BASE=http://127.0.0.1:8101/v1 ELEVEN_LABS_API_BASE=http://127.0.0.1:8102 python server.py
+    python loadtest.py --target http://127.0.0.1:8000
+"""
+import argparse
+import asyncio
+import base64
+import contextvars
+import json
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
+
+import handler
+import metrics
+from chunked_stt import ChunkedTranscriber
+from pipeline import run_pipelined
+from scheduler import current_user
+
+
+async def _iterate_in_thread(iterator, context=None):
+    # Drive a blocking iterator on a worker thread and yield its items here
+    queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterator:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    # The worker runs in a copy of this context, or the one given, so the
+    # turn keeps its trace and user
+    context = context or contextvars.copy_context()
+    producer = loop.run_in_executor(None, context.run, produce)
+    while True:
+        item = await queue.get()
+        if item is done:
+            break
+        if isinstance(item, Exception):
+            raise item
+        yield item
+    await producer
+
+
+async def _event(request):
+    # Translate the request into the API Gateway event the handler expects
+    return {
+        "headers": dict(request.headers),
+        "queryStringParameters": dict(request.query_params),
+        "body": base64.b64encode(await request.body()).decode("ascii"),
+        "isBase64Encoded": True,
+    }
+
+
+def _response(result):
+    body = result.get("body", "")
+    body = base64.b64decode(body) if result.get("isBase64Encoded") else body.encode("utf-8")
+    return Response(body, status_code=result["statusCode"], headers=result.get("headers"),
+                    media_type=(result.get("headers") or {}).get("Content-Type", "application/json"))
+
+
+async def get_answer(request):
+    event = await _event(request)
+    return _response(await run_in_threadpool(handler.handler, event, None))
+
+
+async def get_answer_stream(request):
+    event = await _event(request)
+    loop = asyncio.get_running_loop()
+    # The turn and its audio run in one context, the request's trace spans both
+    context = contextvars.copy_context()
+    result, chunks = await loop.run_in_executor(None, context.run, handler.stream_response, event)
+    if chunks is None:
+        return _response(result)
+    return StreamingResponse(_iterate_in_thread(chunks, context), status_code=result["statusCode"],
+                             headers=result["headers"], media_type=result["headers"]["Content-Type"])
+
+
+async def get_metrics(request):
+    return JSONResponse({"stages": metrics.stage_percentiles(), "tts_cache": handler.tts_cache.stats})
+
+
+async def healthz(request):
+    return JSONResponse({"status": "ok"})
+
+
+async def _voice_turn_text(websocket, message):
+    body = {**message, "audioProfile": handler.negotiate_profile(None, message.get("audioProfile"))}
+    # Counting tokens for the compaction is CPU work, keep it off the event loop
+    messages = await run_in_threadpool(handler.compact_messages, body)
+    if not body.get("isAudioResponse", False):
+        generated_text = await run_in_threadpool(handler.generate_chat_completion, messages)
+        await websocket.send_json({"type": "done", "generated_text": generated_text})
+        return
+
+    # Sentences and their audio are sent as soon as each one is synthesized
+    sentences = []
+    pipeline = run_pipelined(handler.stream_chat_completion(messages),
+                             lambda text: handler.synthesize_speech(text, body["audioProfile"]),
+                             handler.PIPELINE_MAX_WORKERS)
+    async for sentence, audio in _iterate_in_thread(pipeline):
+        sentences.append(sentence)
+        await websocket.send_json({"type": "sentence", "text": sentence})
+        await websocket.send_bytes(audio)
+    await websocket.send_json({"type": "done", "generated_text": " ".join(sentences)})
+
+
+async def _voice_turn_audio(websocket, utterance, audio_data, transcriber=None):
+    target = handler.shadowing_target(utterance, audio_data)
+    if transcriber is not None:
+        transcription = await run_in_threadpool(transcriber.finish)
+    else:
+        transcription = await run_in_threadpool(handler.transcribe_audio, audio_data)
+    message = {"type": "transcription", "text": transcription}
+    if target is not None:
+        message["score"] = handler.score_turn(target, transcription)
+    await websocket.send_json(message)
+
+
+async def voice(websocket):
+    await websocket.accept()
+    utterance = None
+    chunks = []
+    transcriber = None
+    partial = ""
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+
+            if message.get("bytes") is not None:
+                if utterance is None:
+                    await websocket.send_json({"type": "error", "message": "Send audio_start before audio."})
+                    continue
+                chunks.append(message["bytes"])
+                if transcriber is not None:
+                    transcriber.add(message["bytes"])
+                    if transcriber.partial() != partial:
+                        partial = transcriber.partial()
+                        await websocket.send_json({"type": "partial_transcription", "text": partial})
+                continue
+
+            trace = metrics.start_trace()
+            status_code = 200
+            try:
+                data = json.loads(message.get("text") or "{}")
+                kind = data.get("type")
+                current_user.set(str(data.get("userId") or data.get("conversationId") or "anonymous"))
+                trace.annotate(transport="websocket", message_type=kind)
+                if kind == "audio_start":
+                    utterance, chunks, partial = data, [], ""
+                    transcriber = ChunkedTranscriber(handler.transcribe_audio, int(data.get("overlap", 1))) \
+                        if data.get("chunked", False) else None
+                elif kind == "audio_end":
+                    if utterance is None:
+                        raise ValueError("audio_end without audio_start.")
+                    audio_data, utterance_fields, utterance_transcriber = b"".join(chunks), utterance, transcriber
+                    utterance, chunks, transcriber = None, [], None
+                    await _voice_turn_audio(websocket, utterance_fields, audio_data, utterance_transcriber)
+                elif kind == "text":
+                    await _voice_turn_text(websocket, data)
+                else:
+                    raise ValueError(f"Unknown message type '{kind}'.")
+            except (ValueError, KeyError) as e:
+                status_code = 400
+                metrics.annotate(error=str(e))
+                await websocket.send_json({"type": "error", "message": str(e)})
+            except Exception as e:
+                import traceback
+                status_code = 500
+                metrics.annotate(error=str(e))
+                print(traceback.format_exc())
+                print(f"Error: {str(e)}")
+                await websocket.send_json({"type": "error",
+                                           "message": "An error occurred while processing the request."})
+            finally:
+                # Audio chunks are just buffered, only the control messages are traced
+                trace.finish(status_code)
+    except WebSocketDisconnect:
+        pass
+
+
+app = Starlette(routes=[
+    Route("/get-answer", get_answer, methods=["POST"]),
+    Route("/get-answer/stream", get_answer_stream, methods=["POST"]),
+    Route("/metrics", get_metrics),
+    Route("/healthz", healthz),
+    WebSocketRoute("/voice", voice),
+])
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the chatbot backend as a local ASGI server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--stub", action="store_true", help="answer with local stub providers instead of "
+                                                            "calling OpenAI and ElevenLabs")
+    args = parser.parse_args()
+
+    if args.stub:
+        import stub_providers
+        stub_providers.install(handler)
+
+    uvicorn.run(app, host=args.host, port=args.port)
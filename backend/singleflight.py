@@ -0,0 +1,51 @@
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one.
+
+    The first caller for a key runs fn; callers arriving while it is still
+    running wait and get the same result, or the same exception raised.
+    Nothing is remembered once the call finishes, caching is left to the
+    caller.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "shared": 0}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.stats["shared"] += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.stats["calls"] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
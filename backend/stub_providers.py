@@ -0,0 +1,81 @@
+import random
+import time
+
+import openai
+
+# Silent MPEG-1 Layer III frame (128 kbps, 44.1 kHz), repeated to make clips of any length
+_SILENT_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413
+
+STUB_SENTENCES = (
+    "The quick brown fox jumps over the lazy dog.",
+    "I would like a cup of coffee, please.",
+    "She walks to the library every morning before class.",
+    "Learning a language takes patience and daily practice.",
+)
+
+
+def _sleep(latency):
+    # Latency with some jitter so percentiles aren't flat
+    if latency:
+        time.sleep(random.uniform(0.5, 1.5) * latency)
+
+
+class _Object(dict):
+    # Minimal stand-in for the SDK's OpenAIObject: keys readable as attributes
+    __getattr__ = dict.get
+
+
+class _StubTTSResponse:
+    status_code = 200
+
+    def __init__(self, content, chunk_latency):
+        self.content = content
+        self.chunk_latency = chunk_latency
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=4096):
+        for start in range(0, len(self.content), chunk_size):
+            _sleep(self.chunk_latency)
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+def install(handler, stt_latency=0.3, chat_latency=0.5, tts_latency=0.4):
+    """Replace the OpenAI and ElevenLabs calls of the handler module with local stubs.
+
+    The stubs sit below the provider clients, so retries, scheduling, caching
+    and metrics behave as they do against the real providers. Latencies are
+    in seconds.
+    """
+
+    def transcribe(model=None, file=None, **kwargs):
+        _sleep(stt_latency)
+        return {"text": "stub transcription of the learner's sentence"}
+
+    def create(model=None, messages=None, stream=False, **kwargs):
+        text = f'"{random.choice(STUB_SENTENCES)}"'
+        if not stream:
+            _sleep(chat_latency)
+            return _Object(choices=[{"message": {"role": "assistant", "content": text}}])
+
+        def chunks():
+            words = text.split(" ")
+            for i, word in enumerate(words):
+                _sleep(chat_latency / len(words))
+                yield _Object(choices=[{"delta": {"content": word if i == 0 else " " + word}}])
+
+        return chunks()
+
+    def tts_request(generated_text, stream=False, output_format=None, voice_id=None):
+        _sleep(tts_latency if not stream else tts_latency / 4)
+        # Roughly one frame (26 ms) per character
+        content = _SILENT_FRAME * max(len(generated_text), 1)
+        return _StubTTSResponse(content, tts_latency / 20 if stream else 0)
+
+    openai.Audio.transcribe = transcribe
+    openai.ChatCompletion.create = create
+    handler._tts_request = tts_request
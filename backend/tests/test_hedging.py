@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+
+from hedging import Hedger
+
+
+class _Response:
+    def __init__(self, name):
+        self.name = name
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+
+def _attempts(*behaviours):
+    # fn whose n-th call runs behaviours[n], and the responses it returned
+    calls = []
+    lock = threading.Lock()
+
+    def fn():
+        with lock:
+            attempt = len(calls)
+            calls.append(attempt)
+        return behaviours[attempt]()
+
+    return fn, calls
+
+
+def _answer(name, after=0.0, release=None):
+    def behaviour():
+        if release is not None:
+            release.wait(5)
+        time.sleep(after)
+        return _Response(name)
+    return behaviour
+
+
+def _fail(message, after=0.0):
+    def behaviour():
+        time.sleep(after)
+        raise RuntimeError(message)
+    return behaviour
+
+
+def test_fast_call_is_not_hedged():
+    hedger = Hedger("tts", budget=1.0, default_delay=1.0)
+    fn, calls = _attempts(_answer("primary"))
+
+    assert hedger.run(fn).name == "primary"
+    assert calls == [0]
+    assert hedger.stats == {"calls": 1, "hedges_fired": 0, "hedges_won": 0}
+
+
+def test_hedge_wins_and_the_slow_primary_is_closed():
+    hedger = Hedger("tts", budget=1.0, default_delay=0.05)
+    release_primary = threading.Event()
+    primary = []
+
+    def slow_primary():
+        response = _Response("primary")
+        primary.append(response)
+        release_primary.wait(5)
+        return response
+
+    fn, _ = _attempts(slow_primary, _answer("hedge"))
+
+    result = hedger.run(fn)
+    assert result.name == "hedge"
+    assert not result.closed.is_set()
+    assert hedger.stats == {"calls": 1, "hedges_fired": 1, "hedges_won": 1}
+
+    # The loser is closed as soon as it returns
+    release_primary.set()
+    assert primary[0].closed.wait(5)
+
+
+def test_primary_wins_and_the_hedge_is_closed():
+    hedger = Hedger("tts", budget=1.0, default_delay=0.05)
+    hedge = []
+
+    def slow_hedge():
+        response = _Response("hedge")
+        hedge.append(response)
+        time.sleep(0.3)
+        return response
+
+    fn, calls = _attempts(_answer("primary", after=0.1), slow_hedge)
+
+    assert hedger.run(fn).name == "primary"
+    assert calls == [0, 1]
+    assert hedger.stats["hedges_won"] == 0
+    assert hedge[0].closed.wait(5)
+
+
+def test_failed_attempt_falls_back_to_the_other():
+    hedger = Hedger("tts", budget=1.0, default_delay=0.05)
+    fn, _ = _attempts(_fail("primary failed", after=0.1), _answer("hedge", after=0.2))
+
+    assert hedger.run(fn).name == "hedge"
+
+
+def test_error_raised_when_every_attempt_fails():
+    hedger = Hedger("tts", budget=1.0, default_delay=0.05)
+    fn, _ = _attempts(_fail("primary failed", after=0.1), _fail("hedge failed"))
+
+    with pytest.raises(RuntimeError):
+        hedger.run(fn)
+
+
+def test_budget_limits_the_hedges_fired():
+    hedger = Hedger("tts", budget=0.5, default_delay=0.01)
+    for _ in range(4):
+        fn, _ = _attempts(_answer("primary", after=0.05), _answer("hedge", after=0.05))
+        hedger.run(fn)
+
+    assert hedger.stats["calls"] == 4
+    assert hedger.stats["hedges_fired"] == 2
@@ -0,0 +1,138 @@
+import threading
+import time
+
+import pytest
+
+from idempotency import (Idempotency, MemoryResponseStore, DiskResponseStore, IdempotencyKeyReusedError,
+                         RequestInProgressError)
+
+
+def _slow_turn(calls, started=None, release=None, status_code=200):
+    def turn():
+        calls.append(threading.get_ident())
+        if started is not None:
+            started.set()
+        if release is not None:
+            release.wait(5)
+        return {"statusCode": status_code, "body": f"answer {len(calls)}"}
+    return turn
+
+
+def _run_concurrently(targets):
+    results = [None] * len(targets)
+
+    def run(i, target):
+        try:
+            results[i] = target()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i, target)) for i, target in enumerate(targets)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def test_concurrent_retries_run_the_turn_once():
+    idempotency = Idempotency(MemoryResponseStore(), poll_interval=0.01)
+    calls = []
+    release = threading.Event()
+    turn = _slow_turn(calls, release=release)
+    threading.Timer(0.1, release.set).start()
+
+    results = _run_concurrently([lambda: idempotency.run("key", "body", turn)] * 8)
+
+    assert len(calls) == 1
+    assert all(response == {"statusCode": 200, "body": "answer 1"} for response, _ in results)
+    assert sorted(replayed for _, replayed in results) == [False] + [True] * 7
+    assert idempotency.stats == {"executed": 1, "replayed": 7}
+
+
+def test_processes_sharing_a_store_run_the_turn_once(tmp_path):
+    # One Idempotency per process, they only meet through the store's pending marker
+    store = DiskResponseStore(str(tmp_path))
+    processes = [Idempotency(store, poll_interval=0.01) for _ in range(4)]
+    calls = []
+    release = threading.Event()
+    turn = _slow_turn(calls, release=release)
+    threading.Timer(0.1, release.set).start()
+
+    results = _run_concurrently([lambda p=p: p.run("key", "body", turn) for p in processes])
+
+    assert len(calls) == 1
+    assert [replayed for _, replayed in results].count(False) == 1
+    assert len({response["body"] for response, _ in results}) == 1
+
+
+def test_completed_response_is_replayed():
+    idempotency = Idempotency(MemoryResponseStore())
+    calls = []
+
+    first, replayed_first = idempotency.run("key", "body", _slow_turn(calls))
+    second, replayed_second = idempotency.run("key", "body", _slow_turn(calls))
+
+    assert len(calls) == 1
+    assert (replayed_first, replayed_second) == (False, True)
+    assert first == second
+
+
+def test_key_reused_for_another_body_is_rejected():
+    idempotency = Idempotency(MemoryResponseStore())
+    calls = []
+    idempotency.run("key", "body", _slow_turn(calls))
+
+    with pytest.raises(IdempotencyKeyReusedError):
+        idempotency.run("key", "other body", _slow_turn(calls))
+    assert len(calls) == 1
+
+
+def test_key_reused_while_pending_is_rejected():
+    idempotency = Idempotency(MemoryResponseStore(), poll_interval=0.01)
+    calls = []
+    started, release = threading.Event(), threading.Event()
+    first = threading.Thread(target=idempotency.run, args=("key", "body", _slow_turn(calls, started, release)))
+    first.start()
+    started.wait(5)
+    try:
+        with pytest.raises(IdempotencyKeyReusedError):
+            idempotency.run("key", "other body", _slow_turn(calls))
+    finally:
+        release.set()
+        first.join(5)
+    assert len(calls) == 1
+
+
+def test_retry_gives_up_on_a_pending_request():
+    idempotency = Idempotency(MemoryResponseStore(), pending_ttl=0.1, poll_interval=0.01)
+    idempotency.store.claim("key", "body")
+
+    started = time.monotonic()
+    with pytest.raises(RequestInProgressError):
+        idempotency.run("key", "body", _slow_turn([]))
+    assert time.monotonic() - started < 2
+
+
+@pytest.mark.parametrize("status_code", [500, 503, 429])
+def test_failed_turns_are_not_stored(status_code):
+    idempotency = Idempotency(MemoryResponseStore())
+    calls = []
+
+    idempotency.run("key", "body", _slow_turn(calls, status_code=status_code))
+    _, replayed = idempotency.run("key", "body", _slow_turn(calls, status_code=status_code))
+
+    assert len(calls) == 2
+    assert not replayed
+
+
+def test_exception_releases_the_key():
+    idempotency = Idempotency(MemoryResponseStore())
+
+    def failing_turn():
+        raise RuntimeError("provider down")
+
+    with pytest.raises(RuntimeError):
+        idempotency.run("key", "body", failing_turn)
+    response, replayed = idempotency.run("key", "body", _slow_turn([]))
+    assert response["statusCode"] == 200 and not replayed
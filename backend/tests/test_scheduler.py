@@ -0,0 +1,125 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import ProviderScheduler, RateLimitedError
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def _queued(scheduler):
+    with scheduler._cond:
+        return sum(len(queue) for queue in scheduler._queues.values())
+
+
+def test_slots_are_granted_round_robin_across_users():
+    scheduler = ProviderScheduler("openai", {}, max_concurrency=1)
+    scheduler.acquire({"requests": 1}, timeout=1, user="holder")
+    granted = []
+
+    def call(user):
+        scheduler.acquire({"requests": 1}, timeout=5, user=user)
+        granted.append(user)
+        scheduler.release(200, 0.1)
+
+    # A busy user queues three calls before another user queues one
+    threads = []
+    for user in ["busy", "busy", "busy", "other"]:
+        threads.append(threading.Thread(target=call, args=(user,)))
+        threads[-1].start()
+        _wait_for(lambda: _queued(scheduler) == len(threads))
+
+    scheduler.release(200, 0.1)
+    for thread in threads:
+        thread.join(5)
+
+    assert granted == ["busy", "other", "busy", "busy"]
+    assert scheduler.in_flight == 0
+
+
+def test_waiter_is_rejected_at_its_deadline():
+    scheduler = ProviderScheduler("openai", {}, max_concurrency=1)
+    scheduler.acquire({"requests": 1}, timeout=1, user="holder")
+
+    with pytest.raises(RateLimitedError):
+        scheduler.acquire({"requests": 1}, timeout=0.05, user="late")
+    assert scheduler.stats["rejected"] == 1
+    assert _queued(scheduler) == 0
+
+
+def test_exhausted_quota_is_rejected_and_given_back():
+    scheduler = ProviderScheduler("elevenlabs", {"characters": 600})
+
+    scheduler.acquire({"characters": 500}, timeout=1)
+    scheduler.release(200, 0.1)
+    with pytest.raises(RateLimitedError) as raised:
+        scheduler.acquire({"characters": 500}, timeout=0.1)
+    assert raised.value.retry_after > 0
+    assert scheduler.in_flight == 0
+
+    # The rejected call's characters were given back
+    scheduler.acquire({"characters": 100}, timeout=0.1)
+    scheduler.release(200, 0.1)
+
+
+def test_limit_is_halved_on_429_down_to_the_minimum():
+    scheduler = ProviderScheduler("openai", {}, max_concurrency=16, min_concurrency=2)
+
+    limits = []
+    for _ in range(4):
+        scheduler.acquire({"requests": 1}, timeout=1)
+        scheduler.release(429, 0.1)
+        limits.append(scheduler.limit)
+
+    assert limits == [8, 4, 2, 2]
+
+
+def test_limit_grows_additively_on_success():
+    scheduler = ProviderScheduler("openai", {}, max_concurrency=16)
+    scheduler.limit = 4.0
+
+    for _ in range(4):
+        scheduler.acquire({"requests": 1}, timeout=1)
+        scheduler.release(200, 0.1)
+
+    # About one more slot per window of limit successful calls
+    assert 4.9 < scheduler.limit < 5.0
+
+
+def test_limit_shrinks_when_the_provider_gets_slow():
+    scheduler = ProviderScheduler("openai", {}, max_concurrency=10, target_latency=1.0)
+
+    scheduler.acquire({"requests": 1}, timeout=1)
+    scheduler.release(200, 2.5)
+
+    assert scheduler.limit == pytest.approx(9.0)
+
+
+def test_limit_is_kept_when_the_call_never_got_an_answer():
+    scheduler = ProviderScheduler("openai", {}, max_concurrency=8)
+
+    scheduler.acquire({"requests": 1}, timeout=1)
+    scheduler.release(None, 0.0)
+    scheduler.acquire({"requests": 1}, timeout=1)
+    scheduler.release(400, 0.1)
+
+    assert scheduler.limit == 8
+
+
+def test_lowered_limit_holds_back_new_calls():
+    scheduler = ProviderScheduler("openai", {}, max_concurrency=2)
+    scheduler.acquire({"requests": 1}, timeout=1, user="a")
+    scheduler.acquire({"requests": 1}, timeout=1, user="b")
+    scheduler.release(429, 0.1)
+
+    # One call still in flight and a limit of one, no slot until it finishes
+    with pytest.raises(RateLimitedError):
+        scheduler.acquire({"requests": 1}, timeout=0.05, user="c")
+    scheduler.release(200, 0.1)
+    scheduler.acquire({"requests": 1}, timeout=0.05, user="c")
@@ -0,0 +1,90 @@
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def _join_flight(flight, key, fn, waiters):
+    # Start the leader, then waiters that join while fn is still running
+    outcomes = []
+
+    def call():
+        try:
+            outcomes.append(flight.do(key, fn))
+        except Exception as e:
+            outcomes.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(waiters + 1)]
+    threads[0].start()
+    _wait_for(lambda: flight.stats["calls"] == 1)
+    for thread in threads[1:]:
+        thread.start()
+    _wait_for(lambda: flight.stats["shared"] == waiters)
+    return threads, outcomes
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def render():
+        calls.append(1)
+        release.wait(5)
+        return b"audio"
+
+    threads, outcomes = _join_flight(flight, "key", render, waiters=5)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert outcomes == [b"audio"] * 6
+
+
+def test_error_is_raised_to_every_waiter():
+    flight = SingleFlight()
+    release = threading.Event()
+    error = RuntimeError("TTS failed")
+
+    def render():
+        release.wait(5)
+        raise error
+
+    threads, outcomes = _join_flight(flight, "key", render, waiters=5)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(outcomes) == 6
+    assert all(outcome is error for outcome in outcomes)
+
+
+def test_finished_call_is_not_remembered():
+    flight = SingleFlight()
+
+    with pytest.raises(RuntimeError):
+        flight.do("key", lambda: (_ for _ in ()).throw(RuntimeError("first attempt")))
+    assert flight.do("key", lambda: "second attempt") == "second attempt"
+    assert flight.stats == {"calls": 2, "shared": 0}
+
+
+def test_different_keys_do_not_wait_for_each_other():
+    flight = SingleFlight()
+    release = threading.Event()
+    leader = threading.Thread(target=flight.do, args=("slow", release.wait, 5))
+    leader.start()
+    try:
+        assert flight.do("fast", lambda: "done") == "done"
+    finally:
+        release.set()
+        leader.join(5)
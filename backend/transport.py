@@ -0,0 +1,196 @@
+import base64
+import binascii
+import json
+import re
+from urllib.parse import quote
+
+# Uploads above this are rejected before anything is decoded
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+# Room for the JSON fields (chat history, lesson) next to the audio in a JSON body
+MAX_FIELDS_BYTES = 1024 * 1024
+
+BINARY_AUDIO_TYPES = ("audio/", "application/octet-stream")
+
+
+class PayloadTooLargeError(ValueError):
+    """The request carries more audio than MAX_UPLOAD_BYTES."""
+
+
+def header(event, name):
+    """Case-insensitive lookup of a request header."""
+    name = name.lower()
+    for key, value in (event.get("headers") or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _check_size(size, max_bytes, what="Audio upload"):
+    if size > max_bytes:
+        raise PayloadTooLargeError(f"{what} of {size} bytes exceeds the limit of {max_bytes} bytes.")
+
+
+def _base64_size(length):
+    # Upper bound of the decoded size of length base64 characters
+    return length // 4 * 3 + 3
+
+
+def decode_base64(data, max_bytes=MAX_UPLOAD_BYTES):
+    """Decode base64 or a base64 data URL without splitting or copying the payload more than once.
+
+    Args:
+        data (str or bytes): base64 text, optionally prefixed with "data:...;base64,"
+        max_bytes (int): largest accepted decoded size
+
+    Returns:
+        bytes: decoded data
+    """
+    if isinstance(data, str):
+        data = data.encode("ascii")
+    view = memoryview(data)
+
+    # Only look for the data URL comma in the prefix
+    comma = data.find(b",", 0, 256)
+    if comma != -1:
+        view = view[comma + 1:]
+
+    _check_size(_base64_size(len(view)), max_bytes)
+    try:
+        return binascii.a2b_base64(view)
+    except binascii.Error as e:
+        raise ValueError(f"Invalid base64 audio: {e}")
+
+
+def _raw_body(event, max_bytes):
+    body = event.get("body") or b""
+    if event.get("isBase64Encoded"):
+        return decode_base64(body, max_bytes)
+    body = body.encode("latin-1") if isinstance(body, str) else body
+    _check_size(len(body), max_bytes)
+    return body
+
+
+def parse_multipart(data, content_type):
+    """Split a multipart/form-data body into its fields.
+
+    Returns:
+        dict: field name to memoryview over data, no part is copied
+    """
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not match:
+        raise ValueError("Multipart request without a boundary.")
+    delimiter = b"--" + match.group(1).encode("latin-1")
+
+    view = memoryview(data)
+    fields = {}
+    position = data.find(delimiter)
+    while position != -1:
+        start = position + len(delimiter)
+        if data[start:start + 2] == b"--":
+            break
+        headers_end = data.find(b"\r\n\r\n", start)
+        if headers_end == -1:
+            raise ValueError("Malformed multipart body.")
+        part_headers = bytes(view[start:headers_end]).decode("utf-8", "replace")
+        next_position = data.find(delimiter, headers_end)
+        if next_position == -1:
+            raise ValueError("Malformed multipart body.")
+
+        name = re.search(r'name="([^"]*)"', part_headers)
+        if name:
+            # The part ends with the CRLF that precedes the next delimiter
+            fields[name.group(1)] = view[headers_end + 4:next_position - 2]
+        position = next_position
+    return fields
+
+
+def _query_flag(value):
+    return str(value).lower() in ("1", "true", "yes")
+
+
+def parse_request(event, max_bytes=MAX_UPLOAD_BYTES):
+    """Read the request body and the uploaded audio from any supported transport.
+
+    JSON bodies carry audio as a base64 data URL in "audio". multipart/form-data
+    bodies carry it in an "audio" part, next to an optional "payload" part with
+    the JSON fields. Raw audio/* or application/octet-stream bodies are the audio
+    itself, with isAudioResponse and conversationId as query parameters.
+
+    Returns:
+        (dict, bytes or None): request fields and the decoded audio
+    """
+    # The multipart boundary is case-sensitive, only the media type is not
+    content_type = header(event, "content-type") or "application/json"
+    media_type = content_type.lower()
+
+    if media_type.startswith("multipart/form-data"):
+        fields = parse_multipart(_raw_body(event, max_bytes), content_type)
+        body = json.loads(bytes(fields["payload"]).decode("utf-8")) if "payload" in fields else {}
+        audio_data = fields.get("audio")
+        return body, audio_data.tobytes() if audio_data is not None else None
+
+    if media_type.startswith(BINARY_AUDIO_TYPES):
+        query = event.get("queryStringParameters") or {}
+        body = {"isAudioResponse": _query_flag(query.get("isAudioResponse", False))}
+        if "conversationId" in query:
+            body["conversationId"] = query["conversationId"]
+        return body, _raw_body(event, max_bytes)
+
+    # The audio is base64 inside the JSON, bound the body before parsing it
+    max_body = max_bytes // 3 * 4 + 4 + MAX_FIELDS_BYTES
+    raw = event["body"]
+    if event.get("isBase64Encoded"):
+        _check_size(_base64_size(len(raw)), max_body, "Request body")
+        raw = base64.b64decode(raw)
+    else:
+        _check_size(len(raw), max_body, "Request body")
+    body = json.loads(raw)
+    audio_data = decode_base64(body.pop("audio"), max_bytes) if "audio" in body else None
+    return body, audio_data
+
+
+def accepts_binary(event):
+    """Whether the Accept header names a binary media type. API Gateway only
+    decodes a binary body for the client when it does."""
+    accept = (header(event, "accept") or "").lower()
+    return any(media_type.strip().startswith(BINARY_AUDIO_TYPES) for media_type in accept.split(","))
+
+
+def wants_binary(event, body):
+    """Whether the client asked for raw audio instead of base64 in JSON.
+
+    responseFormat "binary" picks raw audio when the Accept header lists
+    both JSON and audio, without a binary Accept the response stays JSON.
+    """
+    if not accepts_binary(event):
+        return False
+    accept = (header(event, "accept") or "").lower()
+    return body.get("responseFormat") == "binary" or accept.startswith(BINARY_AUDIO_TYPES)
+
+
+def text_headers(transcription, generated_text, score=None):
+    headers = {
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Expose-Headers": "X-Transcription, X-Generated-Text",
+        "X-Transcription": quote(transcription or ""),
+        "X-Generated-Text": quote(generated_text or ""),
+    }
+    if score is not None:
+        # The score, its diffs and the new level as URL-encoded JSON
+        headers["Access-Control-Expose-Headers"] += ", X-Score"
+        headers["X-Score"] = quote(json.dumps(score, separators=(",", ":")))
+    return headers
+
+
+def binary_response(audio, transcription, generated_text, content_type="audio/mpeg", score=None):
+    """Raw audio response. API Gateway turns it back into binary for the client
+    (the media type is listed in binaryMediaTypes), the texts and the score go
+    in headers."""
+    headers = text_headers(transcription, generated_text, score)
+    headers["Content-Type"] = content_type
+    return {
+        "statusCode": 200,
+        "headers": headers,
+        "isBase64Encoded": True,
+        "body": base64.b64encode(audio).decode("ascii"),
+    }
@@ -0,0 +1,250 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    """Normalize text so that trivially different requests share a cache entry."""
+    text = unicodedata.normalize("NFC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def cache_key(text, voice_id, voice_settings, variant=""):
+    """Content address of a TTS clip.
+
+    Args:
+        text (str): text to synthesize
+        voice_id (str): ElevenLabs voice id
+        voice_settings (dict): ElevenLabs voice settings
+        variant (str): anything else that changes the rendered audio
+
+    Returns:
+        str: hex sha256 digest
+    """
+    payload = json.dumps({
+        "text": normalize_text(text),
+        "voice_id": voice_id,
+        "voice_settings": voice_settings,
+        "variant": variant,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryLRU:
+    """Bounded in-memory tier, evicts the least recently used clips first."""
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            audio = self._items.get(key)
+            if audio is not None:
+                self._items.move_to_end(key)
+            return audio
+
+    def put(self, key, audio):
+        if len(audio) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._items[key] = audio
+            self.size += len(audio)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class AudioStore:
+    """Persistent tier. Subclasses store clips somewhere that outlives the container's memory.
+
+    extension is the file extension of the clip's audio format ("mp3", "ogg").
+    """
+
+    def get(self, key, extension="mp3"):
+        raise NotImplementedError
+
+    def put(self, key, audio, extension="mp3"):
+        raise NotImplementedError
+
+
+class DiskStore(AudioStore):
+    """Stores clips as <directory>/<key[:2]>/<key>.<extension>.
+
+    With max_bytes set the least recently used clips are deleted once the
+    directory grows past it, like MemoryLRU. Reads touch a clip's mtime.
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = None
+        self._lock = threading.Lock()
+
+    def path(self, key, extension="mp3"):
+        return os.path.join(self.directory, key[:2], f"{key}.{extension}")
+
+    def get(self, key, extension="mp3"):
+        path = self.path(key, extension)
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+        except FileNotFoundError:
+            return None
+        if self.max_bytes is not None:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+        return audio
+
+    def _clips(self):
+        clips = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                clips.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        return clips
+
+    def _evict(self):
+        # Other processes may share the directory, so the listing is the
+        # truth once the running total says the cap is reached
+        clips = sorted(self._clips())
+        self.size = sum(size for _, size, _ in clips)
+        for _, size, path in clips:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def put(self, key, audio, extension="mp3"):
+        path = self.path(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so readers never see a partial clip
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(audio)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        if self.max_bytes is not None:
+            with self._lock:
+                if self.size is None:
+                    self.size = sum(size for _, size, _ in self._clips())
+                else:
+                    self.size += len(audio)
+                if self.size > self.max_bytes:
+                    self._evict()
+
+
+class LibraryStore(AudioStore):
+    """Read-only store over a pre-rendered audio library (see prerender.py).
+
+    The manifest lists every clip, so misses are answered without touching
+    the file system.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, self.MANIFEST)) as f:
+            self.entries = json.load(f)["clips"]
+
+    def get(self, key, extension="mp3"):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        with open(os.path.join(self.directory, entry["path"]), "rb") as f:
+            return f.read()
+
+    def put(self, key, audio, extension="mp3"):
+        pass
+
+
+class ChainedStore(AudioStore):
+    """Reads from the first store that has the clip, writes to all of them."""
+
+    def __init__(self, stores):
+        self.stores = stores
+
+    def get(self, key, extension="mp3"):
+        for store in self.stores:
+            audio = store.get(key, extension)
+            if audio is not None:
+                return audio
+        return None
+
+    def put(self, key, audio, extension="mp3"):
+        for store in self.stores:
+            store.put(key, audio, extension)
+
+
+class TTSCache:
+    """Two-tier audio cache: MemoryLRU in front of an optional AudioStore."""
+
+    def __init__(self, memory, store=None):
+        self.memory = memory
+        self.store = store
+        self.stats = {"memory_hits": 0, "store_hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def get(self, key, extension="mp3"):
+        audio = self.memory.get(key)
+        if audio is not None:
+            self._count("memory_hits")
+            return audio
+
+        if self.store is not None:
+            try:
+                audio = self.store.get(key, extension)
+            except Exception as e:
+                print(f"TTS cache store read failed: {e}")
+                audio = None
+            if audio is not None:
+                self._count("store_hits")
+                self.memory.put(key, audio)
+                return audio
+
+        self._count("misses")
+        return None
+
+    def put(self, key, audio, extension="mp3"):
+        self.memory.put(key, audio)
+        if self.store is not None:
+            try:
+                self.store.put(key, audio, extension)
+            except Exception as e:
+                # A failing persistent tier must not fail the request
+                print(f"TTS cache store write failed: {e}")
+
+    def get_or_render(self, key, render, extension="mp3"):
+        audio = self.get(key, extension)
+        if audio is None:
+            audio = render()
+            self.put(key, audio, extension)
+        return audio
@@ -0,0 +1,63 @@
+import contextvars
+import time
+
+import metrics
+
+_deadline = contextvars.ContextVar("turn_deadline", default=None)
+
+# Kept back from the Lambda's remaining time to encode and return the response
+RESPONSE_MARGIN = 1.0
+
+# Stage latency assumed until enough turns have been observed
+MIN_SAMPLES = 20
+
+
+class BudgetExhaustedError(Exception):
+    """The turn ran out of time before a provider call could complete."""
+
+
+def start(seconds):
+    """Give the current turn seconds to finish, for this context and the workers it spawns."""
+    _deadline.set(time.monotonic() + seconds)
+
+
+def start_from(context, margin=RESPONSE_MARGIN):
+    """Derive the turn's budget from a Lambda context, no budget without one.
+
+    Returns:
+        float: the budget in seconds, or None
+    """
+    get_remaining = getattr(context, "get_remaining_time_in_millis", None)
+    if get_remaining is None:
+        _deadline.set(None)
+        return None
+    seconds = max(0.0, get_remaining() / 1000 - margin)
+    start(seconds)
+    return seconds
+
+
+def remaining():
+    """Seconds left in the current turn, None if it has no budget."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def exhausted():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def expected(stage, default, quantile=95):
+    """Expected latency of a stage in seconds, its rolling p95 once known."""
+    percentiles = metrics.histogram(stage).percentiles((quantile,))
+    if percentiles.get("count", 0) < MIN_SAMPLES:
+        return default
+    return percentiles[f"p{quantile}"] / 1000
+
+
+def fits(stage, default):
+    """Whether the remaining budget covers a typical run of stage."""
+    left = remaining()
+    return left is None or left >= expected(stage, default)
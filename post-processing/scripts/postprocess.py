@@ -1,9 +1,12 @@
+import datetime
 import json
 import os
 import re
 import numpy as np
 import pandas as pd
 import pymongo as pymongo
+import pyarrow as pa
+from bson import ObjectId
 import scipy.stats as stats
 from scipy.stats import ttest_ind
 from diff_match_patch import diff_match_patch
@@ -21,6 +24,30 @@ client = OpenAI(
     api_key="YOUR_OPENAI_API_KEY",
 )
 
+# Local Parquet copy of sessions.userStudyDb, partitioned by day (Asia/Seoul),
+# kept up to date by sync_snapshot()
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', 'userStudyDb_snapshot')
+SYNC_STATE_FILE = '_sync_state.json'
+SYNC_BATCH_SIZE = 10000
+# Inserts from different app servers can reach MongoDB slightly out of _id order
+SYNC_LOOKBACK_SECONDS = 300
+
+# Compute daily usage and per-level statistics in MongoDB instead of pandas
+AGGREGATION_PUSHDOWN = os.environ.get('AGGREGATION_PUSHDOWN', 'false').lower() == 'true'
+STUDY_TIMEZONE = 'Asia/Seoul'
+
+# Fields the chatbot writes for every lesson, with the types they are stored as
+SNAPSHOT_SCHEMA = pa.schema([
+    ('_id', pa.string()),
+    ('user', pa.string()),
+    ('originalText', pa.string()),
+    ('transcribedText', pa.string()),
+    ('level', pa.int64()),
+    ('theme', pa.string()),
+    ('timestamp', pa.int64()),
+    ('day', pa.string()),
+])
+
 
 def load_csv_data(file_path):
     """Load data from a CSV file and return a pandas DataFrame.
@@ -253,16 +280,14 @@ def filter_punctuations(s):
     return s.lower()
 
 
-def analyze_personalized_group(collection):
+def analyze_personalized_group(personalized_data):
     """Analyze data for the personalized group and perform detailed analysis on theme and originalText.
 
     Args:
-        collection (pymongo.collection.Collection): MongoDB collection object
+        personalized_data (pandas DataFrame): snapshot rows of the personalized group, see load_snapshot
     """
     try:
-        # Query data for personalized group
-        personalized_data = list(collection.find({"user": {"$in": p_or_np["P"]}}))
-        df_personalized = pd.DataFrame(personalized_data)
+        df_personalized = personalized_data.copy()
 
         # Convert 'timestamp' to datetime
         df_personalized['timestamp'] = pd.to_datetime(df_personalized['timestamp'], unit='ms')
@@ -432,6 +457,272 @@ def original_text_to_csv(valid_entries, output_csv='original_texts.csv'):
         print(f"An error occurred while exporting to CSV: {e}")
 
 
+def load_sync_state(snapshot_dir=SNAPSHOT_DIR):
+    """Load the high-water mark of the last sync.
+
+    Args:
+        snapshot_dir (str): snapshot directory
+
+    Returns:
+        state (dict): '_id' of the newest synced document and 'recent_ids' synced within the lookback window,
+            or None before the first sync
+    """
+    path = os.path.join(snapshot_dir, SYNC_STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        state = json.load(f)
+    state.setdefault('recent_ids', [])
+    return state
+
+
+def save_sync_state(state, snapshot_dir=SNAPSHOT_DIR):
+    """Save the high-water mark, through a temporary file so a crash never leaves half of it."""
+    path = os.path.join(snapshot_dir, SYNC_STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def documents_to_frame(documents):
+    """Convert MongoDB documents to a DataFrame with the snapshot's columns and types.
+
+    Args:
+        documents (list): documents from sessions.userStudyDb
+
+    Returns:
+        frame (pandas DataFrame): one row per document, partitioned by its Asia/Seoul day
+    """
+    frame = pd.DataFrame(documents).reindex(columns=[field.name for field in SNAPSHOT_SCHEMA])
+    frame['_id'] = frame['_id'].astype(str)
+    frame['level'] = pd.to_numeric(frame['level'], errors='coerce').round().astype('Int64')
+    frame['timestamp'] = pd.to_numeric(frame['timestamp'], errors='coerce').astype('Int64')
+    for column in ['user', 'originalText', 'transcribedText', 'theme']:
+        frame[column] = frame[column].where(frame[column].isna(), frame[column].astype(str))
+    frame['day'] = pd.to_datetime(frame['timestamp'], unit='ms').dt.tz_localize('UTC').dt.tz_convert(
+        'Asia/Seoul').dt.strftime('%Y-%m-%d').fillna('unknown')
+    return frame
+
+
+def write_snapshot_batch(documents, state, snapshot_dir=SNAPSHOT_DIR):
+    """Write a batch of documents to the snapshot and move the high-water mark past them.
+
+    Args:
+        documents (list): new documents, in _id order
+        state (dict): current sync state, None before the first sync
+        snapshot_dir (str): snapshot directory
+
+    Returns:
+        state (dict): the state saved after the batch
+    """
+    frame = documents_to_frame(documents)
+    frame.to_parquet(snapshot_dir, engine='pyarrow', partition_cols=['day'], index=False, schema=SNAPSHOT_SCHEMA)
+
+    mark = documents[-1]['_id']
+    if state is not None and ObjectId(state['_id']) > mark:
+        mark = ObjectId(state['_id'])
+    # Remember what was synced inside the lookback window, the next sync reads that window again
+    window_start = mark.generation_time - datetime.timedelta(seconds=SYNC_LOOKBACK_SECONDS)
+    recent_ids = (state['recent_ids'] if state is not None else []) + [str(d['_id']) for d in documents]
+    state = {"_id": str(mark),
+             "recent_ids": [i for i in recent_ids if ObjectId(i).generation_time >= window_start]}
+    save_sync_state(state, snapshot_dir)
+    return state
+
+
+def sync_snapshot(collection, snapshot_dir=SNAPSHOT_DIR, batch_size=SYNC_BATCH_SIZE):
+    """Append the documents added since the last sync to the local Parquet snapshot.
+
+    The high-water mark is the server-generated _id, not the timestamp the
+    client sent, so a late insert carrying an old timestamp is still picked
+    up. ObjectIds from different app servers are only ordered to the second
+    (and their clocks), so every sync reads the last SYNC_LOOKBACK_SECONDS
+    before the mark again and skips the documents it already has. The mark
+    moves forward after every batch written, so an interrupted sync resumes
+    where it stopped.
+
+    Args:
+        collection (pymongo.collection.Collection): sessions.userStudyDb
+        snapshot_dir (str): snapshot directory
+        batch_size (int): documents per Parquet write
+
+    Returns:
+        synced (int): number of new documents
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    state = load_sync_state(snapshot_dir)
+    query = {}
+    seen = set()
+    if state is not None:
+        window_start = ObjectId(state['_id']).generation_time - datetime.timedelta(seconds=SYNC_LOOKBACK_SECONDS)
+        query = {"_id": {"$gt": ObjectId.from_datetime(window_start)}}
+        seen = set(state['recent_ids'])
+
+    cursor = collection.find(query).sort("_id", pymongo.ASCENDING)
+    synced = 0
+    batch = []
+    for document in cursor.batch_size(batch_size):
+        if str(document['_id']) in seen:
+            continue
+        batch.append(document)
+        if len(batch) == batch_size:
+            state = write_snapshot_batch(batch, state, snapshot_dir)
+            synced += len(batch)
+            batch = []
+    if batch:
+        state = write_snapshot_batch(batch, state, snapshot_dir)
+        synced += len(batch)
+    print(f"Synced {synced} new documents into {snapshot_dir}")
+    return synced
+
+
+def load_snapshot(users=None, snapshot_dir=SNAPSHOT_DIR):
+    """Load the local snapshot, optionally for some users only.
+
+    Args:
+        users (list): users to load, all users if None
+        snapshot_dir (str): snapshot directory
+
+    Returns:
+        data (pandas DataFrame): the synced documents, oldest first
+    """
+    filters = [('user', 'in', list(users))] if users is not None else None
+    data = pd.read_parquet(snapshot_dir, engine='pyarrow', filters=filters)
+    # A sync interrupted between writing a batch and saving the state writes it twice
+    data = data.drop(columns=['day']).drop_duplicates(subset='_id')
+    return data.sort_values(by=['timestamp', '_id']).reset_index(drop=True)
+
+
+def group_users(group):
+    """Users of a study group: 'P', 'NP', 'both' for everyone in p_or_np, or None for all users."""
+    if group is None:
+        return None
+    if group == 'both':
+        return sorted(set(p_or_np["P"]).union(set(p_or_np["NP"])))
+    return list(p_or_np[group])
+
+
+def match_users(users=None):
+    """$match stage restricting a pipeline to some users, empty when users is None."""
+    return [] if users is None else [{"$match": {"user": {"$in": list(users)}}}]
+
+
+def daily_usage_pipeline(users=None, timezone=STUDY_TIMEZONE):
+    """Aggregation pipeline counting each user's lessons per day.
+
+    Equivalent to data.groupby(['user', pd.Grouper(key='date', freq='D')]).size()
+    with dates in the study's timezone. Needs MongoDB 5.0 for $dateTrunc.
+
+    Args:
+        users (list): users to count, all users if None
+        timezone (str): timezone the days start in
+
+    Returns:
+        pipeline (list): stages for collection.aggregate()
+    """
+    return match_users(users) + [
+        {"$group": {
+            "_id": {
+                "user": "$user",
+                "date": {"$dateTrunc": {"date": {"$toDate": "$timestamp"}, "unit": "day", "timezone": timezone}},
+            },
+            "count": {"$sum": 1},
+        }},
+        {"$project": {"_id": 0, "user": "$_id.user", "date": "$_id.date", "count": 1}},
+        {"$sort": {"user": 1, "date": 1}},
+    ]
+
+
+def level_stats_pipeline(users=None):
+    """Aggregation pipeline for the per-level statistics of average_score_length_by_level.
+
+    Returns the mean and standard deviation of the level over all lessons,
+    and per level the number of lessons and the mean and standard deviation
+    of the transcribed sentence length in words. Scores need diff-match-patch
+    and are still computed locally.
+
+    Args:
+        users (list): users to include, all users if None
+
+    Returns:
+        pipeline (list): stages for collection.aggregate()
+    """
+    return match_users(users) + [
+        {"$set": {"sentence_length": {"$size": {"$regexFindAll": {"input": "$transcribedText", "regex": r"\S+"}}}}},
+        {"$facet": {
+            "overall": [
+                {"$group": {"_id": None, "average_level": {"$avg": "$level"},
+                            "std_dev_level": {"$stdDevSamp": "$level"},
+                            "average_sentence_length": {"$avg": "$sentence_length"}}},
+                {"$project": {"_id": 0}},
+            ],
+            "by_level": [
+                {"$group": {"_id": "$level", "mean": {"$avg": "$sentence_length"},
+                            "std": {"$stdDevSamp": "$sentence_length"}, "total_lessons": {"$sum": 1}}},
+                {"$sort": {"_id": 1}},
+            ],
+        }},
+    ]
+
+
+def aggregate_daily_usage(collection, users=None):
+    """Count each user's lessons per day in MongoDB.
+
+    Args:
+        collection (pymongo.collection.Collection): sessions.userStudyDb
+        users (list): users to count, all users if None
+
+    Returns:
+        data_points_by_user (pandas DataFrame): 'user', 'date' (Asia/Seoul) and 'count' columns
+    """
+    results = list(collection.aggregate(daily_usage_pipeline(users)))
+    data_points_by_user = pd.DataFrame(results, columns=['user', 'date', 'count'])
+    # pymongo returns naive UTC datetimes
+    data_points_by_user['date'] = pd.to_datetime(data_points_by_user['date']).dt.tz_localize('UTC').dt.tz_convert(
+        STUDY_TIMEZONE)
+    return data_points_by_user
+
+
+def aggregate_level_stats(collection, users=None):
+    """Compute the level and sentence length statistics in MongoDB and print them.
+
+    Args:
+        collection (pymongo.collection.Collection): sessions.userStudyDb
+        users (list): users to include, all users if None
+
+    Returns:
+        overall (dict): average_level, std_dev_level and average_sentence_length
+        average_length_by_level (pandas DataFrame): 'mean', 'std' and 'total_lessons' per level
+    """
+    result = next(collection.aggregate(level_stats_pipeline(users)))
+    overall = result['overall'][0] if result['overall'] else {}
+    average_length_by_level = pd.DataFrame(result['by_level'], columns=['_id', 'mean', 'std', 'total_lessons'])
+    average_length_by_level = average_length_by_level.rename(columns={'_id': 'level'}).set_index('level')
+
+    print(f"Average level: {overall.get('average_level')} ± {overall.get('std_dev_level')}")
+    print(overall.get('average_sentence_length'))
+    print(average_length_by_level)
+    return overall, average_length_by_level
+
+
+def fetch_lessons(collection, users=None):
+    """Fetch the lesson fields the local analyses use, for what can't be computed in MongoDB.
+
+    Scores need diff-match-patch, the personalized group's analyses need the
+    texts, themes and timestamps. Fields other than the snapshot's are left out.
+
+    Args:
+        collection (pymongo.collection.Collection): sessions.userStudyDb
+        users (list): users to include, all users if None
+
+    Returns:
+        data (pandas DataFrame): one row per lesson, with the snapshot's columns and types
+    """
+    query = {} if users is None else {"user": {"$in": list(users)}}
+    projection = {field.name: 1 for field in SNAPSHOT_SCHEMA if field.name != 'day'}
+    return documents_to_frame(list(collection.find(query, projection)))
+
+
 def load_mongodb_data():
     """Load data from MongoDB and return a pandas DataFrame.
 
@@ -456,13 +747,23 @@ def load_mongodb_data():
         grab_original_text_from_string(data)
         plot_pre_survey()
 
-        # # Query data from collection
-        data = pd.DataFrame(list(col.find()))
-        data['date'] = pd.to_datetime(data['timestamp'], unit='ms').dt.tz_localize('UTC').dt.tz_convert('Asia/Seoul')
-        data_filtered_p = data[data['user'].isin(p_or_np["P"])]
-        data_filtered_np = data[data['user'].isin(p_or_np["NP"])]
-        combined_users = set(p_or_np["P"]).union(set(p_or_np["NP"]))
-        data_points_by_user = data.groupby(['user', pd.Grouper(key='date', freq='D')]).size().reset_index(name='count')
+        if AGGREGATION_PUSHDOWN:
+            # Counts and level statistics come back already aggregated. The study
+            # groups' lessons are fetched once, for the scores and the text analyses
+            data_points_by_user = aggregate_daily_usage(col, list(users_from_csv))
+            lessons = fetch_lessons(col, group_users('both'))
+            data_filtered_p = lessons[lessons['user'].isin(p_or_np["P"])]
+        else:
+            # Only documents added since the last run are fetched, the analyses read the local snapshot
+            sync_snapshot(col)
+            data = load_snapshot()
+            data['date'] = pd.to_datetime(data['timestamp'], unit='ms').dt.tz_localize('UTC').dt.tz_convert(
+                'Asia/Seoul')
+            data_filtered_p = data[data['user'].isin(p_or_np["P"])]
+            data_filtered_np = data[data['user'].isin(p_or_np["NP"])]
+            combined_users = set(p_or_np["P"]).union(set(p_or_np["NP"]))
+            data_points_by_user = data.groupby(['user', pd.Grouper(key='date', freq='D')]).size().reset_index(
+                name='count')
 
         # Convert 'date' column to datetime type
         data_points_by_user['date'] = pd.to_datetime(data_points_by_user['date'])
@@ -477,9 +778,16 @@ def load_mongodb_data():
 
         plot_data_points_user(data_points_by_user_filtered)
 
-        average_score_length_by_level(data[data['user'].isin(combined_users)])
-        average_score_length_by_level(data_filtered_p)
-        average_score_length_by_level(data_filtered_np)
+        if AGGREGATION_PUSHDOWN:
+            for group in ['both', 'P', 'NP']:
+                aggregate_level_stats(col, group_users(group))
+                group_lessons = lessons[lessons['user'].isin(group_users(group))].copy()
+                print(calculate_average_score(group_lessons))
+                print(calculate_average_score_per_level(group_lessons))
+        else:
+            average_score_length_by_level(data[data['user'].isin(combined_users)])
+            average_score_length_by_level(data_filtered_p)
+            average_score_length_by_level(data_filtered_np)
 
         # Calculate descriptive statistics
         descriptive_stats = calculate_descriptive_stats(data_points_by_user_filtered, p_or_np)
@@ -494,7 +802,7 @@ def load_mongodb_data():
         print(ttest_result_total)
 
         # Additional analysis on personalized group
-        analyze_personalized_group(col)
+        analyze_personalized_group(data_filtered_p if AGGREGATION_PUSHDOWN else load_snapshot(users=p_or_np["P"]))
 
         # Define the column names for user theme and original text
         user_theme_column = 'theme'